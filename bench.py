@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+import gc
+import json
+import platform
+import random
+import sys
+import timeit
+
+import vendored  # Puts lib/ on sys.path; keep it above click.
+
+import click
+
+import chargen
+import main
+
+
+# --------------------------------------------------------------------------- #
+# Utilities.                                                                  #
+# --------------------------------------------------------------------------- #
+
+# A p50 this much slower than the baseline's is reported as a regression.
+DEFAULT_THRESHOLD = 0.10
+
+PERCENTILES = (50, 90, 99)
+
+# (name, setup) pairs; setup() returns the zero-argument function to time.
+BENCHMARKS = []
+
+
+def benchmark(name):
+  def register(setup):
+    BENCHMARKS.append((name, setup))
+    return setup
+  return register
+
+
+def percentile(sorted_samples, p):
+  """Nearest-rank percentile of an ascending list."""
+  rank = max(0, int(round(p / 100.0 * len(sorted_samples))) - 1)
+  return sorted_samples[rank]
+
+
+def measure(fn, repeat=200, budget=2.0):
+  """Times fn up to repeat times, stopping early once budget seconds pass.
+
+  Returns a summary in milliseconds along with "retained", the net number of
+  gc-tracked objects (containers and instances) one call leaves alive,
+  averaged over ten calls with the collector paused; objects a call frees
+  again before returning are not counted. Caches warm up on the
+  first, untimed call, so the figures describe steady state.
+  """
+  fn()
+  gc.collect()
+  gc.disable()
+  try:
+    before = len(gc.get_objects())
+    for _ in xrange(10):
+      fn()
+    retained = (len(gc.get_objects()) - before) / 10.0
+  finally:
+    gc.enable()
+  samples = []
+  timer = timeit.default_timer
+  deadline = timer() + budget
+  while len(samples) < repeat and (len(samples) < 5 or timer() < deadline):
+    start = timer()
+    fn()
+    samples.append((timer() - start) * 1000)
+  samples.sort()
+  summary = dict(
+      ("p{}".format(p), percentile(samples, p)) for p in PERCENTILES)
+  summary.update(
+      n=len(samples), min=samples[0], max=samples[-1],
+      mean=sum(samples) / len(samples), retained=retained)
+  return summary
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+  """Returns [(name, old p50, new p50, ratio)] for the benchmarks whose p50
+  grew by more than threshold over the baseline."""
+  regressions = []
+  for name, result in sorted(results.items()):
+    old = baseline.get(name)
+    if old is None or not old["p50"]:
+      continue
+    ratio = result["p50"] / old["p50"]
+    if ratio > 1 + threshold:
+      regressions.append((name, old["p50"], result["p50"], ratio))
+  return regressions
+
+
+# --------------------------------------------------------------------------- #
+# Benchmarks.                                                                 #
+# --------------------------------------------------------------------------- #
+
+NAMED = ("Armored", "Assassin", "Medic")
+QUERIES = ("armored", "asassin", "guild nav", "wild")
+
+
+@benchmark("read_archetypes")
+def _read_archetypes():
+  return chargen.read_archetypes
+
+
+@benchmark("archetype_parse")
+def _archetype_parse():
+  # Bodies are otherwise parsed on first use, outside the timed call.
+  txt = chargen._read_text(chargen.ARCHETYPES_PATH)
+
+  def parse():
+    archetypes = chargen.parse_archetypes(txt)
+    for a in archetypes:
+      a._parse_body()
+    return archetypes
+  return parse
+
+
+@benchmark("character_random")
+def _character_random():
+  rng = random.Random(0)
+  return lambda: chargen.Character(rng=rng)
+
+
+@benchmark("character_named")
+def _character_named():
+  return lambda: chargen.Character(*NAMED)
+
+
+@benchmark("character_str")
+def _character_str():
+  ch = chargen.Character(*NAMED)
+  return lambda: str(ch)
+
+
+@benchmark("best_guess")
+def _best_guess():
+  names = [a.name.lower() for a in chargen.current_catalog().archetypes]
+  return lambda: [chargen.best_guess(q, names) for q in QUERIES]
+
+
+@benchmark("format_relevant_techniques")
+def _format_relevant_techniques():
+  ch = chargen.Character(*NAMED)
+  return ch.format_relevant_techniques
+
+
+ROUTES = (
+    "/", "/?seed=1", "/list", "/search/armor", "/search/\"medic\"?and=steel",
+    "/technique/Contact", "/Armored,Assassin,Medic", "/armord,asasin",
+    "/api/character", "/api/character/Armored,Assassin",
+    "/api/characters?n=100&seed=1")
+
+
+def _route(path):
+  def setup():
+    client = main.app.test_client()
+    return lambda: client.get(path).data
+  return setup
+
+
+for _path in ROUTES:
+  benchmark("route " + _path)(_route(_path))
+
+
+# --------------------------------------------------------------------------- #
+# Driver.                                                                     #
+# --------------------------------------------------------------------------- #
+
+@click.command()
+@click.option("--only", default=None,
+              help="Run only the benchmarks whose names contain this.")
+@click.option("--repeat", default=200, type=click.IntRange(min=5))
+@click.option("--budget", default=2.0, type=float,
+              help="Seconds to spend timing each benchmark, at most.")
+@click.option("--out", type=click.Path(), default=None,
+              help="Write the results to this JSON file.")
+@click.option("--baseline", type=click.File("rb"), default=None,
+              help="Compare against results saved with --out.")
+@click.option("--threshold", default=DEFAULT_THRESHOLD, type=float)
+def cli(only, repeat, budget, out, baseline, threshold):
+  """Times the chargen hot paths and the app's routes."""
+  results = {}
+  click.echo("{name:<40} {n:>5} {p50:>9} {p90:>9} {p99:>9} {obj:>9}".format(
+      name="benchmark", n="n", p50="p50 ms", p90="p90 ms", p99="p99 ms",
+      obj="retained"))
+  for name, setup in BENCHMARKS:
+    if only and only not in name:
+      continue
+    r = results[name] = measure(setup(), repeat, budget)
+    click.echo(
+        "{name:<40} {n:>5} {p50:>9.3f} {p90:>9.3f} {p99:>9.3f} "
+        "{retained:>9.1f}".format(name=name, **r))
+  if out:
+    with open(out, "w") as f:
+      json.dump({
+          "python": platform.python_version(),
+          "catalog": chargen.current_catalog().version,
+          "results": results}, f, indent=2, sort_keys=True)
+  if baseline:
+    regressions = compare(results, json.load(baseline)["results"], threshold)
+    for name, old, new, ratio in regressions:
+      click.echo("REGRESSION {name}: p50 {old:.3f} -> {new:.3f} ms "
+                 "({ratio:.2f}x)".format(
+                     name=name, old=old, new=new, ratio=ratio), err=True)
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  cli()
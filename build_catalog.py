@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import timeit
+
+import chargen
+
+
+# --------------------------------------------------------------------------- #
+# Build and measurement.                                                      #
+# --------------------------------------------------------------------------- #
+
+def build(path):
+  digest = chargen.build_catalog(path)
+  print "Wrote {path} (sources {digest}).".format(path=path, digest=digest)
+
+
+def measure(path, repeat=20):
+  def best(fn):
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1000
+  parse_ms = best(lambda: chargen.load_catalog(path=None))
+  artifact_ms = best(lambda: chargen.load_catalog(path=path))
+  print "Catalog load, best of {n}:".format(n=repeat)
+  print "    text parse: {ms:8.2f} ms".format(ms=parse_ms)
+  print "    artifact:   {ms:8.2f} ms".format(ms=artifact_ms)
+
+
+# --------------------------------------------------------------------------- #
+# Driver.                                                                     #
+# --------------------------------------------------------------------------- #
+
+def main(argv):
+  path = chargen.CATALOG_PATH
+  build(path)
+  if "--measure" in argv:
+    measure(path)
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -1,20 +1,85 @@
 # -*- coding: utf-8 -*-
 
+import array
+import hashlib
+import heapq
+import logging
+import marshal
+import os
 import random
 import re
 import sys
+import threading
+import time
+
+import lru
+import metrics
+import textindex
+import timing
 
 
 # --------------------------------------------------------------------------- #
 # Utilities.                                                                  #
 # --------------------------------------------------------------------------- #
 
-def read_archetypes():
-  with open("archetypes.txt", "r") as f:
-    arch_txt = f.read()
+ARCHETYPES_PATH = "archetypes.txt"
+TECHNIQUES_PATH = "techniques.txt"
+CATALOG_PATH = "catalog.bin"
+
+# Bump whenever the parsed layout of archetypes or techniques changes, so stale
+# artifacts are ignored rather than loaded.
+CATALOG_FORMAT = 3
+
+
+class _memoized_property(object):
+  # Computes an attribute on first access and caches it on the instance. Two
+  # threads racing on first access both compute it; the results are equal.
+
+  def __init__(self, fn):
+    self.fn = fn
+    self.__name__ = fn.__name__
+    self.__doc__ = fn.__doc__
+
+  def __get__(self, obj, owner):
+    if obj is None:
+      return self
+    value = obj.__dict__[self.__name__] = self.fn(obj)
+    return value
+
+
+def popcount(mask):
+  return bin(mask).count("1")
+
+
+iter_bits = textindex.iter_bits
+
+
+def _read_text(path):
+  with open(path, "r") as f:
+    return f.read()
+
+
+def _split_blocks(txt):
+  blocks = txt.split("\n\n")
+  return blocks, tuple(hashlib.sha1(b).digest() for b in blocks)
+
+
+def _parse_blocks(blocks, digests, make, reusable):
+  # reusable maps block digests to objects parsed from an earlier catalog;
+  # only blocks missing from it are parsed again.
+  return [
+      reusable[d] if d in reusable else make(b)
+      for b, d in zip(blocks, digests)]
+
+
+def parse_archetypes(arch_txt):
   return [Archetype(s) for s in arch_txt.split("\n\n")]
 
 
+def read_archetypes():
+  return parse_archetypes(_read_text(ARCHETYPES_PATH))
+
+
 def similarity(s1, s2):
   bonus = s1 in s2
   s1, s2 = set(s1), set(s2)
@@ -30,58 +95,372 @@ def best_guess(query, opts):
     return max(scored)[1]
 
 
-def format_item(it, base_indent=4):
-  words = it.replace("\n", " ::BREAK:: ").split()
-  s = " " * base_indent
+# Limits on what one request may ask NameIndex.resolve_all to resolve.
+MAX_NAMES = 16
+MAX_NAME_LENGTH = 64
+
+
+# Character sheets are wrapped to this many columns unless asked otherwise.
+WIDTH = 80
+
+# Wrapped items keyed by (item, width, base_indent); items repeat across
+# characters, so each is wrapped once per layout.
+_wrapped_items = lru.LRUCache(maxsize=16384)
+
+# Catalog.fragments keyed by (archetype block digest, width), so archetypes
+# a reload leaves alone keep theirs.
+_fragments = lru.LRUCache(maxsize=4096)
+
+
+def _wrap(it, base_indent, width):
+  # Words fill lines up to width; continuation lines are indented four more
+  # columns, and a newline in the item starts an indented sub-paragraph.
+  indent = " " * base_indent
+  parts = [indent]
   line_len = base_indent
   extra_indent = False
-  for word in words:
-    l = len(word) + 1
-    if word == "::BREAK::":
+  for i, paragraph in enumerate(it.split("\n")):
+    if i:
       line_len = base_indent + 4
       extra_indent = True
-      s += "\n    " + (" " * base_indent)
-    elif line_len + l > 80:
-      line_len = base_indent + 5 + (4 * extra_indent) + len(word)
-      s += (
-          "\n    " + (" " * base_indent) +
-          ("    " * extra_indent) + word + " ")
-    else:
-      line_len += l
-      s += word + " "
-  return s.rstrip()
+      parts.append("\n    " + indent)
+    for word in paragraph.split():
+      l = len(word) + 1
+      if line_len + l > width:
+        line_len = base_indent + 5 + (4 * extra_indent) + len(word)
+        parts.append("\n    " + indent + ("    " * extra_indent) + word + " ")
+      else:
+        line_len += l
+        parts.append(word + " ")
+  return "".join(parts).rstrip()
 
 
-def format_list(l):
-  return "\n".join([format_item(it) for it in l])
+def format_item(it, base_indent=4, width=WIDTH):
+  key = (it, width, base_indent)
+  wrapped = _wrapped_items.get(key)
+  if wrapped is None:
+    wrapped = _wrap(it, base_indent, width)
+    _wrapped_items.put(key, wrapped)
+  return wrapped
 
 
-def format_technique(s):
+def format_technique(s, width=WIDTH):
   s = s.replace("•", "-")
   return "{title}\n{body}".format(
       title=s.split("\n")[0].upper(),
-      body="\n".join(
-          [format_item(it, base_indent=0) for it in s.split("\n")[1:]]))
+      body="\n".join([
+          format_item(it, base_indent=0, width=width)
+          for it in s.split("\n")[1:]]))
+
+
+def parse_techniques(tech_txt):
+  return [Technique(s) for s in tech_txt.split("\n\n")]
 
 
 def read_techniques():
-  with open("techniques.txt", "r") as f:
-    tech_txt = f.read()
-  return [format_technique(s) for s in tech_txt.split("\n\n")]
+  return parse_techniques(_read_text(TECHNIQUES_PATH))
+
+
+def source_hash(arch_txt, tech_txt):
+  h = hashlib.sha1()
+  h.update(str(CATALOG_FORMAT))
+  for txt in (arch_txt, tech_txt):
+    h.update(str(len(txt)) + ":")
+    h.update(txt)
+  return h.hexdigest()
+
+
+def build_catalog(path=CATALOG_PATH):
+  """Compiles the text catalogs into a marshalled artifact at path.
+
+  The artifact records the hash of the sources it was built from, so that
+  load_catalog can tell when it has gone stale.
+  """
+  arch_txt = _read_text(ARCHETYPES_PATH)
+  tech_txt = _read_text(TECHNIQUES_PATH)
+  arch_blocks, arch_digests = _split_blocks(arch_txt)
+  tech_blocks, tech_digests = _split_blocks(tech_txt)
+  artifact = {
+      "format": CATALOG_FORMAT,
+      "hash": source_hash(arch_txt, tech_txt),
+      "archetypes": [Archetype(b).to_state() for b in arch_blocks],
+      "techniques": tech_blocks,
+      "digests": (arch_digests, tech_digests)}
+  with open(path, "wb") as f:
+    marshal.dump(artifact, f, 2)
+  return artifact["hash"]
+
+
+def _load_artifact(path, expected_hash):
+  try:
+    with open(path, "rb") as f:
+      artifact = marshal.load(f)
+  except (IOError, EOFError, ValueError, TypeError):
+    return None
+  if (not isinstance(artifact, dict) or
+      artifact.get("format") != CATALOG_FORMAT or
+      artifact.get("hash") != expected_hash):
+    return None
+  return (
+      [Archetype.from_state(st) for st in artifact["archetypes"]],
+      [Technique(s) for s in artifact["techniques"]],
+      artifact["digests"])
+
+
+def load_catalog(path=CATALOG_PATH, previous=None):
+  """Returns a Catalog.
+
+  Loads the prebuilt artifact when it matches the current text sources, and
+  falls back to parsing the text when it is missing or stale. Pass path=None
+  to always parse. When parsing, blocks unchanged since the previous Catalog
+  reuse its parsed objects.
+  """
+  modified = max(mtime for mtime, _ in _source_stats())
+  arch_txt = _read_text(ARCHETYPES_PATH)
+  tech_txt = _read_text(TECHNIQUES_PATH)
+  version = source_hash(arch_txt, tech_txt)
+  loaded = _load_artifact(path, version) if path else None
+  if loaded is not None:
+    archetypes, techniques, (arch_digests, tech_digests) = loaded
+  else:
+    arch_blocks, arch_digests = _split_blocks(arch_txt)
+    tech_blocks, tech_digests = _split_blocks(tech_txt)
+    archetypes = _parse_blocks(
+        arch_blocks, arch_digests, Archetype,
+        previous.reusable_archetypes() if previous else {})
+    techniques = _parse_blocks(
+        tech_blocks, tech_digests, Technique,
+        previous.reusable_techniques() if previous else {})
+  catalog = Catalog(
+      archetypes, techniques, version, (arch_digests, tech_digests),
+      modified)
+  if previous is not None:
+    catalog.inherit(previous)
+  return catalog
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def current_catalog():
+  """Returns the process-wide Catalog, loading it on first use."""
+  global _catalog
+  catalog = _catalog
+  if catalog is None:
+    with _catalog_lock:
+      if _catalog is None:
+        _catalog = load_catalog()
+      catalog = _catalog
+  return catalog
+
+
+def _check_archetypes(archetypes):
+  # Edits can parse without error yet leave out fields every request needs,
+  # e.g. a misspelt "power level" line or a stray blank block.
+  for i, arch in enumerate(archetypes):
+    if not arch.name or not isinstance(arch.power_level, int):
+      raise ValueError(
+          "Archetype block {i} ({name!r}) lacks a name or power level."
+          .format(i=i + 1, name=arch.name))
+
+
+def reload_catalog():
+  """Re-reads the text sources and installs a new Catalog if they changed.
+
+  Only blocks whose hash changed are parsed again. The swap is a single
+  reference assignment, so requests holding the previous Catalog keep a
+  consistent snapshot. Returns True if a new catalog was installed, False
+  if the sources were unchanged, and None if they failed to parse or lack
+  a name or power level, in which case the error is logged and the
+  previous catalog stays in place.
+  """
+  global _catalog
+  with _catalog_lock:
+    previous = _catalog
+    try:
+      catalog = load_catalog(path=None, previous=previous)
+      # Bodies are otherwise parsed on first use, long after the reload.
+      for arch in catalog.archetypes:
+        arch._parse_body()
+      _check_archetypes(catalog.archetypes)
+    except Exception:
+      logging.exception("Catalog reload failed; keeping the previous one.")
+      _catalog_reloads.inc(("failed",))
+      return None
+    if previous is not None and catalog.version == previous.version:
+      _catalog_reloads.inc(("unchanged",))
+      return False
+    _catalog = catalog
+    _catalog_reloads.inc(("installed",))
+    return True
+
+
+_watched_stats = None
+_next_watch_check = 0
+_catalog_reloads = metrics.REGISTRY.counter(
+    "exemplar_catalog_reloads_total",
+    "Catalog reloads: installed, unchanged or failed.", ("result",))
+
+
+def _source_stats():
+  stats = []
+  for path in (ARCHETYPES_PATH, TECHNIQUES_PATH):
+    st = os.stat(path)
+    stats.append((st.st_mtime, st.st_size))
+  return stats
+
+
+def maybe_reload_catalog(min_interval=2.0):
+  """Watcher hook: reloads the catalog if its text files changed on disk.
+
+  Cheap enough to call on every request; the files are stat'ed at most once
+  per min_interval seconds. Files that fail to parse are tried again at the
+  next check.
+  """
+  global _watched_stats, _next_watch_check
+  now = time.time()
+  if now < _next_watch_check:
+    return False
+  _next_watch_check = now + min_interval
+  stats = _source_stats()
+  if stats == _watched_stats:
+    return False
+  installed = reload_catalog()
+  if installed is not None:
+    _watched_stats = stats
+  return bool(installed)
 
 
 # --------------------------------------------------------------------------- #
 # Main classes.                                                               #
 # --------------------------------------------------------------------------- #
 
-class Archetype(object):
-    
-  def __init__(self, s):
-    self.raw_text = "".join(ch for ch in s if ord(ch) < 128).lower()
-    self.name = None
-    self.is_order = False
-    self.requirements = None
-    self.power_level = None
+_FIELD_INDICATORS = (
+    "Abilities", "Specialty", "Training", "Traits", "Resources",
+    "Techniques", "Bond Relationship", "Special Rules", "Related Rules")
+_FIELD_RE = re.compile("|".join(re.escape(fi) for fi in _FIELD_INDICATORS))
+_CHOICE_RE = re.compile(r"^(And )?[cC]hoose.*\.")
+_LIST_SPLIT_RE = re.compile(r"[,;] ")
+_NON_ASCII = "".join(chr(i) for i in range(128, 256))
+
+# Guards the deferred body parse of archetypes shared between threads.
+_body_parse_lock = threading.Lock()
+
+
+class _ArchetypeParser(object):
+  """Single-pass state machine over the lines of one archetype block.
+
+  The current field selects a (handler, attribute) row of _TABLE. A line that
+  starts with a field indicator ends any open choice and switches fields; a
+  "Choose ..." line opens a choice that collects lines until the next choice,
+  field or the end of the block.
+  """
+
+  def __init__(self, arch):
+    self.arch = arch
+    self.field = "Name"
+    self.choice_lines = None
+    self.choice_store = None
+
+  def feed(self, line):
+    match = _FIELD_RE.match(line)
+    if match:
+      self.end_choice()
+      self.field = match.group(0)
+      line = line.partition(self.field + " ")[2]
+    handler, attr = self._TABLE[self.field]
+    handler(self, attr, line)
+
+  def end_choice(self):
+    if self.choice_lines:
+      store, attr = self.choice_store
+      store(self, attr, "\n".join(self.choice_lines))
+    self.choice_lines = None
+    self.choice_store = None
+
+  # Stores.
+
+  def _assign(self, attr, line):
+    setattr(self.arch, attr, line)
+
+  def _append(self, attr, line):
+    setattr(self.arch, attr, getattr(self.arch, attr) + [line])
+
+  def _append_entry_or_list(self, attr, line):
+    if not line:
+      return
+    elif line.endswith("."):
+      self._append(attr, line.strip("."))
+    else:
+      setattr(
+          self.arch, attr,
+          getattr(self.arch, attr) + _LIST_SPLIT_RE.split(line))
+
+  def _maybe_choice(self, attr, line, store, fallback):
+    if _CHOICE_RE.match(line):
+      self.end_choice()
+      self.choice_lines = [line]
+      self.choice_store = (store, attr)
+    elif self.choice_lines is not None and line:
+      self.choice_lines.append(line.strip("."))
+    else:
+      fallback(self, attr, line)
+
+  # Field handlers.
+
+  def _name(self, attr, line):
+    self.arch.name = line
+    self.field = "Power Level"
+
+  def _power_level(self, attr, line):
+    arch = self.arch
+    for part in line.split(" • "):
+      if part == "exemplar order":
+        arch.is_order = True
+      elif part.startswith("requires "):
+        arch.requirements = set([
+            name.rpartition("or ")[2].strip()
+            for name in part.partition("requires ")[2].split(", ")])
+      elif part.startswith("power level"):
+        arch.power_level = int(part.rpartition(" ")[2])
+
+  def _abilities(self, attr, line):
+    for entry in line.split(", "):
+      possibly = entry.startswith("possibly")
+      ability, _, raw_dice = entry.rpartition("possibly ")[2].partition(" ")
+      self.arch.abilities[ability] = ("possibly " * possibly) + raw_dice
+
+  def _choice_assign(self, attr, line):
+    self._maybe_choice(
+        attr, line, _ArchetypeParser._assign, _ArchetypeParser._assign)
+
+  def _choice_list(self, attr, line):
+    self._maybe_choice(
+        attr, line, _ArchetypeParser._append,
+        _ArchetypeParser._append_entry_or_list)
+
+  def _nonempty_append(self, attr, line):
+    if line:
+      self._append(attr, line)
+
+  _TABLE = {
+      "Name": (_name, "name"),
+      "Power Level": (_power_level, "power_level"),
+      "Abilities": (_abilities, "abilities"),
+      "Specialty": (_choice_assign, "specialty"),
+      "Training": (_choice_list, "training"),
+      "Traits": (_choice_list, "traits"),
+      "Resources": (_nonempty_append, "resources"),
+      "Techniques": (_choice_list, "techniques"),
+      "Bond Relationship": (_choice_assign, "bond"),
+      "Special Rules": (_assign, "special_rules"),
+      "Related Rules": (_assign, "special_rules")}
+
+
+class _ParsedBody(object):
+
+  def __init__(self):
     self.abilities = {}
     self.specialty = None
     self.training = []
@@ -90,240 +469,586 @@ class Archetype(object):
     self.techniques = []
     self.bond = None
     self.special_rules = None
+
+
+class Archetype(object):
+  """One archetype block of archetypes.txt.
+
+  Only the header (name and power level line) is parsed up front. raw_text
+  and the body fields are filled in on first access, so listing the catalog
+  never pays for parsing abilities, training and the rest.
+  """
+
+  FIELDS = (
+      "raw_text", "name", "is_order", "requirements", "power_level",
+      "abilities", "specialty", "training", "traits", "resources",
+      "techniques", "bond", "special_rules")
+  HEADER_FIELDS = FIELDS[1:5]
+  BODY_FIELDS = FIELDS[5:]
     
-    self._current_field = "Name"
-    self._in_choice = False
-    self._choice_lines = []
-    self._unparsed_lines = []
-    self._choice_end_callback = lambda _: None
-    self._parse_from_string(s)
-  
-  def _parse_from_string(self, s):
-    lines = s.split("\n")
-    while lines:
-      self._parse_line(lines[0].strip())
-      lines = lines[1:]
-    self._choice_end_callback("\n".join(self._choice_lines))
-    self._choice_lines = []
-    self._coice_end_callback = lambda x: None
-    self._in_choice = False
-  
-  def _maybe_handle_choice(self, line, maybe_new_callback):
-    # Return True if the line was totally handled and
-    # nothing more needs to be done.
-    choice_re = re.compile(r"^(And )?[cC]hoose.*\.")
-    if choice_re.match(line):
-      self._choice_end_callback("\n".join(self._choice_lines))
-      self._choice_lines = [line]
-      self._choice_end_callback = maybe_new_callback
-      self._in_choice = True
-      return True
-    elif not self._in_choice:
-      return False
-    elif self._in_choice and line:
-      self._choice_lines.append(line.strip("."))
-      return True
-
-  def _assigner(self, field_name):
-    def assigner(line):
-      if line:
-        setattr(self, field_name, line)
-    return assigner
-  
-  def _appender(self, field_name):
-    def appender(line):
-      if line:
-          setattr(self, field_name, getattr(self, field_name, []) + [line])
-    return appender
-  
-  def _append_entry_or_list(self, field_name, s):
-    if not s:
-      return
-    if not s.endswith("."):
-      split_re = re.compile(r"[,;] ")
-      setattr(
-          self, field_name,
-          getattr(self, field_name, []) + split_re.split(s))
-    elif s.endswith("."):
-      setattr(
-          self, field_name,
-          getattr(self, field_name, []) + [s.strip(".")])
-      
-  def _parse_line(self, line):
-    field_indicators = set([
-        "Abilities", "Specialty", "Training", "Traits", "Resources",
-        "Techniques", "Bond Relationship", "Special Rules", "Related Rules"])
-    for fi in field_indicators:
-      if line.startswith(fi) or line.startswith(fi + " "):
-        self._choice_end_callback("\n".join(self._choice_lines))
-        self._current_field = fi
-        self._choice_lines = []
-        self._coice_end_callback = lambda x: None
-        self._in_choice = False
-        line = line.partition(fi + " ")[2]
-    
-    if self._current_field == "Name":
-      self.name = line
-      self._current_field = "Power Level"
-
-    elif self._current_field == "Power Level":
-      parts = line.split(" • ")
-      for part in parts:
-        if part == "exemplar order":
-          self.is_order = True
-        elif part.startswith("requires "):
-          self.requirements = set([
-              arch.rpartition("or ")[2].strip()
-              for arch in part.partition("requires ")[2].split(", ")])
-        elif part.startswith("power level"):
-          self.power_level = int(part.rpartition(" ")[2])
-    
-    elif self._current_field == "Abilities":
-      entries = line.split(", ")
-      for entry in entries:
-        possibly = entry.startswith("possibly")
-        ability, _, raw_dice = entry.rpartition("possibly ")[2].partition(" ")
-        self.abilities[ability] = ("possibly " * possibly) + raw_dice
-    
-    elif self._current_field == "Specialty":
-      if not self._maybe_handle_choice(line, self._assigner("specialty")):
-        self.specialty = line
+  def __init__(self, s):
+    self.name = None
+    self.is_order = False
+    self.requirements = None
+    self.power_level = None
+    self._source = s
+    self._parse_header(s)
+
+  def __getattr__(self, name):
+    # Only called for attributes not yet set, i.e. deferred fields.
+    if name == "raw_text":
+      self.raw_text = self._source.translate(None, _NON_ASCII).lower()
+      return self.raw_text
+    elif name in self.BODY_FIELDS:
+      self._parse_body()
+      return self.__dict__[name]
+    raise AttributeError(name)
+
+  @classmethod
+  def from_state(cls, state):
+    """Restores an archetype saved by to_state, its body still unparsed."""
+    arch = cls.__new__(cls)
+    for f in cls.HEADER_FIELDS:
+      setattr(arch, f, state[f])
+    arch._source = state["source"]
+    arch._body_start = state["body_start"]
+    return arch
 
-    elif self._current_field == "Training":
-      if not self._maybe_handle_choice(line, self._appender("training")):
-        self._append_entry_or_list("training", line)
+  def to_state(self):
+    # The header fields and the block itself, so that restored archetypes
+    # defer the rest of the parse just like freshly parsed ones.
+    state = dict((f, getattr(self, f)) for f in self.HEADER_FIELDS)
+    state.update(source=self._source, body_start=self._body_start)
+    return state
 
-    elif self._current_field == "Traits":
-      if not self._maybe_handle_choice(line, self._appender("traits")):
-        self._append_entry_or_list("traits", line)
+  def _parse_header(self, s):
+    parser = _ArchetypeParser(self)
+    start = 0
+    for line in s.split("\n"):
+      line = line.strip()
+      if _FIELD_RE.match(line):
+        break
+      parser.feed(line)
+      start += 1
+    self._body_start = start
 
-    elif self._current_field == "Resources":
-      if line:
-        self.resources.append(line)
+  def _parse_body(self):
+    with _body_parse_lock:
+      if "abilities" in self.__dict__:
+        return
+      # Parse into a scratch object and publish all fields at once, so other
+      # threads never observe a half-parsed body. The body opens with a field
+      # indicator, so a fresh parser picks up where the header left off.
+      parser = _ArchetypeParser(_ParsedBody())
+      for line in self._source.split("\n")[self._body_start:]:
+        parser.feed(line.strip())
+      parser.end_choice()
+      self.__dict__.update(vars(parser.arch))
+
+
+class Technique(object):
+  """One technique block of techniques.txt, formatted when first rendered."""
+
+  def __init__(self, s):
+    self.source = s
+    title, _, self.body = s.partition("\n")
+    self.title = title.replace("•", "-").strip()
+    self._text = None
+
+  def __str__(self):
+    return self.render()
 
-    elif self._current_field == "Techniques":
-      if not self._maybe_handle_choice(line, self._appender("techniques")):
-        self._append_entry_or_list("techniques", line)
+  def render(self, width=WIDTH):
+    if width != WIDTH:
+      return format_technique(self.source, width)
+    if self._text is None:
+      self._text = format_technique(self.source)
+    return self._text
 
-    elif self._current_field == "Bond Relationship":
-      if not self._maybe_handle_choice(line, self._assigner("bond")):
-        self.bond = line
 
-    elif self._current_field in ("Special Rules", "Related Rules"):
-      self.special_rules = line
+_name_resolutions = metrics.REGISTRY.counter(
+    "exemplar_name_resolutions_total",
+    "Archetype names resolved, by whether the name was exact, a cached "
+    "guess or scored afresh.", ("result",))
+_name_candidates = metrics.REGISTRY.histogram(
+    "exemplar_name_candidates",
+    "Catalog names scored per fresh guess (the best_guess work).",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200))
 
+
+class NameIndex(object):
+  """Resolves fuzzy archetype names exactly as best_guess would.
+
+  Rather than scoring the query against every name, it counts shared
+  characters through per-character postings, checks substrings only for
+  names containing every character of the query, and caches resolved
+  queries.
+  """
+
+  def __init__(self, names, cache_size=1024):
+    self.names = list(names)
+    self.exact = set(self.names)
+    self.postings = {}
+    self.roots = []
+    for i, name in enumerate(self.names):
+      chars = set(name)
+      self.roots.append(len(chars) ** 0.5)
+      for ch in chars:
+        self.postings.setdefault(ch, []).append(i)
+    self.cache = lru.LRUCache(cache_size)
+
+  def resolve(self, query):
+    """Returns the lowercased catalog name best matching query."""
+    query = query.lower()[:MAX_NAME_LENGTH]
+    if query in self.exact:
+      _name_resolutions.inc(("exact",))
+      return query
+    resolved = self.cache.get(query)
+    if resolved is None:
+      _name_resolutions.inc(("scored",))
+      resolved = self._score(query)
+      self.cache.put(query, resolved)
+    else:
+      _name_resolutions.inc(("cached",))
+    return resolved
+
+  def resolve_all(self, queries):
+    if len(queries) > MAX_NAMES:
+      raise ValueError("At most {n} archetype names per request.".format(
+          n=MAX_NAMES))
+    with timing.phase("resolve"):
+      return [self.resolve(query) for query in queries]
+
+  def _score(self, query):
+    chars = set(query)
+    overlap = {}
+    for ch in chars:
+      for i in self.postings.get(ch, ()):
+        overlap[i] = overlap.get(i, 0) + 1
+    _name_candidates.observe(len(overlap) or len(self.names))
+    if not query or not overlap:
+      # Every name scores the same, as in best_guess.
+      return max(
+          (similarity(query, name), name) for name in self.names)[1]
+    root = len(chars) ** 0.5
+    return max(
+        (float(shared) / (root + self.roots[i]) +
+         (shared == len(chars) and query in self.names[i]),
+         self.names[i])
+        for i, shared in overlap.iteritems())[1]
+
+
+# Character sheet lists and the archetype fields they are gathered from.
+SHEET_FIELDS = (
+    ("specialties", "specialty"), ("training", "training"),
+    ("traits", "traits"), ("resources", "resources"),
+    ("techniques", "techniques"), ("bonds", "bond"),
+    ("special_rules", "special_rules"))
+
+
+ABILITIES = (
+    "Influence", "Logistics", "Medicine", "Perception", "Prowess",
+    "Speed", "Stealth", "Steel", "Survival", "Technology", "Vehicles")
+
+# What an archetype can grant an ability, weakest first. The index of a grant
+# is its rank code in Catalog.ability_matrix; 0 means no grant.
+GRANTS = (None, "possibly 3d", "3d", "3d or 4d", "4d")
+_GRANT_CODES = dict((g, i) for i, g in enumerate(GRANTS))
+
+# Final rating of an ability given its (at most) two strongest grants.
+_MERGED_RATINGS = {
+    ():                       "🎲🎲",
+    ("possibly 3d",):         "🎲🎲              or 🎲🎲🎲   +raise",
+    ("3d",):                  "🎲🎲🎲",
+    ("3d or 4d",):            "🎲🎲🎲            or 🎲🎲🎲🎲 +raise",
+    ("4d",):                  "🎲🎲🎲🎲",
+    ("3d", "3d"):             "🎲🎲🎲   +bonus   or 🎲🎲🎲🎲",
+    ("3d or 4d", "3d"):       "🎲🎲🎲   +bonus   or 🎲🎲🎲🎲",
+    ("3d or 4d", "3d or 4d"): "🎲🎲🎲   +bonus   or 🎲🎲🎲🎲",
+    ("4d", "3d"):             "🎲🎲🎲🎲 +bonus",
+    ("4d", "3d or 4d"):       "🎲🎲🎲🎲 +bonus",
+    ("4d", "4d"):             "🎲🎲🎲🎲 +bonus"}
+RATINGS = (
+    _MERGED_RATINGS[()],
+    _MERGED_RATINGS[("possibly 3d",)],
+    _MERGED_RATINGS[("3d",)],
+    _MERGED_RATINGS[("3d or 4d",)],
+    _MERGED_RATINGS[("3d", "3d")],
+    _MERGED_RATINGS[("4d",)],
+    _MERGED_RATINGS[("4d", "3d")])
+
+# Plain-text names of RATINGS, for tools and queries.
+RATING_LABELS = (
+    "2d", "2d or 3d +raise", "3d", "3d or 4d +raise", "3d +bonus or 4d",
+    "4d", "4d +bonus")
+
+
+def _merged_rating(top, second):
+  grants = tuple(GRANTS[c] for c in (top, second) if c)
+  if len(grants) == 2 and grants[1] == "possibly 3d":
+    grants = grants[:1]
+  return RATINGS.index(_MERGED_RATINGS[grants])
+
+
+# Index into RATINGS for every pair of grant codes, looked up as
+# MERGE_TABLE[top * len(GRANTS) + second] with top >= second.
+MERGE_TABLE = array.array("B", [
+    _merged_rating(top, min(top, second))
+    for top in range(len(GRANTS)) for second in range(len(GRANTS))])
+
+
+# NumPy only speeds up merged_ratings_batch, so it is imported on first use
+# there rather than at every cold start. Holds (numpy, MERGE_TABLE as an
+# array), or (None, None) without NumPy, once tried.
+_numpy_state = None
+
+
+def _numpy():
+  global _numpy_state
+  if _numpy_state is None:
+    try:
+      import numpy
+    except ImportError:
+      _numpy_state = (None, None)
     else:
-      self._unparsed_lines.append(line)
+      _numpy_state = (numpy, numpy.array(MERGE_TABLE, dtype=numpy.uint8))
+  return _numpy_state
+
+
+class Catalog(object):
+  """An immutable snapshot of the parsed archetypes and techniques.
+
+  version is the hash of the text sources and modified their latest mtime.
+  Reloading builds a new Catalog instead of changing this one, so callers
+  should fetch current_catalog() once and use that snapshot for the rest of
+  the request.
+  """
+
+  def __init__(self, archetypes, techniques, version, digests, modified=None):
+    self.archetypes = tuple(archetypes)
+    self.techniques = tuple(techniques)
+    self.version = version
+    self.modified = modified
+    self.archetype_digests, self.technique_digests = digests
+
+  # Indexes that stay valid while these are unchanged; see inherit().
+  _NAME_INDEXES = ("name_index",)
+  _ARCHETYPE_INDEXES = (
+      "rows_by_name", "name_index", "listing", "search_index", "power_levels",
+      "order_mask", "ability_matrix", "ability_array")
+  _TECHNIQUE_INDEXES = ("technique_map", "technique_matcher")
+
+  def inherit(self, previous):
+    """Takes over the indexes previous has built that are still valid here,
+    so that a reload only rebuilds what its edits affect."""
+    names = []
+    if self.archetype_digests == previous.archetype_digests:
+      names.extend(self._ARCHETYPE_INDEXES)
+    elif ([a.name for a in self.archetypes] ==
+          [a.name for a in previous.archetypes]):
+      names.extend(self._NAME_INDEXES)
+    if self.technique_digests == previous.technique_digests:
+      names.extend(self._TECHNIQUE_INDEXES)
+    for name in names:
+      if name in previous.__dict__:
+        self.__dict__[name] = previous.__dict__[name]
+
+  # Sets of archetypes are integer bitmasks over catalog rows: bit i stands
+  # for self.archetypes[i].
+
+  @_memoized_property
+  def rows_by_name(self):
+    """Maps each lowercased archetype name to its row."""
+    return dict((a.name.lower(), i) for i, a in enumerate(self.archetypes))
+
+  @_memoized_property
+  def name_index(self):
+    return NameIndex(a.name.lower() for a in self.archetypes)
+
+  @_memoized_property
+  def listing(self):
+    """The archetypes ordered by power level, then name."""
+    return tuple(sorted(self.archetypes, key=lambda a: (a.power_level, a.name)))
+
+  @_memoized_property
+  def search_index(self):
+    """Full-text index over the raw text of the archetypes in listing."""
+    return textindex.SearchIndex(a.raw_text for a in self.listing)
+
+  def search(self, terms):
+    """Returns the archetypes, in listing order, whose text contains every
+    term. Terms are lowercased; see textindex.SearchIndex.search."""
+    listing = self.listing
+    return [
+        listing[i]
+        for i in self.search_index.search([t.lower() for t in terms])]
+
+  @_memoized_property
+  def technique_map(self):
+    """Maps each lowercased technique title to its Technique."""
+    return dict((t.title.lower(), t) for t in self.techniques)
+
+  @_memoized_property
+  def technique_matcher(self):
+    """Automaton over the lowercased technique titles, in catalog order."""
+    return textindex.AhoCorasick(t.title.lower() for t in self.techniques)
+
+  def techniques_mentioned(self, text):
+    """Returns the techniques whose titles occur in text, ignoring case."""
+    return [
+        self.techniques[i]
+        for i in sorted(self.technique_matcher.search(text.lower()))]
+
+  @_memoized_property
+  def techniques_digest(self):
+    """Hash of every technique block; any of them may be relevant to a
+    character."""
+    return hashlib.sha1("".join(self.technique_digests)).digest()
+
+  def sheet_key(self, mask):
+    """Identifies what the sheet of the archetypes in mask is rendered from:
+    their block digests, in row order, and techniques_digest. It survives
+    reloads that leave those blocks alone."""
+    digests = self.archetype_digests
+    return (tuple(digests[i] for i in iter_bits(mask)),
+            self.techniques_digest)
+
+  @_memoized_property
+  def power_levels(self):
+    return tuple(a.power_level for a in self.archetypes)
+
+  @_memoized_property
+  def order_mask(self):
+    """Bitmask of the archetypes that are exemplar orders."""
+    return sum(1 << i for i, a in enumerate(self.archetypes) if a.is_order)
+
+  def archetypes_of(self, mask):
+    return [self.archetypes[i] for i in iter_bits(mask)]
+
+  def power_level_of(self, mask):
+    levels = self.power_levels
+    return sum(levels[i] for i in iter_bits(mask))
+
+  def is_legal(self, mask):
+    return 2 <= popcount(mask) <= 4 and popcount(mask & self.order_mask) <= 1
+
+  @_memoized_property
+  def ability_matrix(self):
+    """Grant codes as a flat array with one row of len(ABILITIES) per
+    archetype, followed by an all-zero padding row."""
+    matrix = array.array("B")
+    for a in self.archetypes:
+      matrix.extend([_GRANT_CODES[a.abilities.get(ab)] for ab in ABILITIES])
+    matrix.extend([0] * len(ABILITIES))
+    return matrix
+
+  @_memoized_property
+  def ability_array(self):
+    """ability_matrix as a 2-D NumPy array, or None without NumPy."""
+    numpy, _ = _numpy()
+    if numpy is None:
+      return None
+    return numpy.array(self.ability_matrix, dtype=numpy.uint8).reshape(
+        -1, len(ABILITIES))
+
+  def merged_ratings(self, rows):
+    """Returns the RATINGS index of every ability for one set of rows."""
+    matrix = self.ability_matrix
+    width = len(ABILITIES)
+    merged = []
+    for col in xrange(width):
+      top = second = 0
+      for row in rows:
+        code = matrix[row * width + col]
+        if code > top:
+          top, second = code, top
+        elif code > second:
+          second = code
+      merged.append(MERGE_TABLE[top * len(GRANTS) + second])
+    return merged
+
+  def merged_ratings_batch(self, row_groups):
+    """Like merged_ratings, for many sets of rows at once."""
+    row_groups = list(row_groups)
+    numpy, merge_array = _numpy() if row_groups else (None, None)
+    if numpy is None:
+      return [self.merged_ratings(rows) for rows in row_groups]
+    # Pad every group with the all-zero row to a common size of at least two,
+    # so the top two grants are the last two entries after a sort.
+    pad = len(self.archetypes)
+    size = max(2, max(len(rows) for rows in row_groups))
+    rows = numpy.array([
+        list(rows) + [pad] * (size - len(rows)) for rows in row_groups])
+    grants = numpy.sort(self.ability_array[rows], axis=1)
+    codes = grants[:, -1, :] * len(GRANTS) + grants[:, -2, :]
+    return merge_array[codes].tolist()
+
+  def fragments(self, row, width=WIDTH):
+    """Returns the sheet entries one archetype contributes, pre-rendered.
+
+    Maps each of SHEET_FIELDS to a list of (item, wrapped item) pairs sorted
+    by item, where items are labelled "(Archetype) ...". Built once per
+    archetype block and width.
+    """
+    key = (self.archetype_digests[row], width)
+    fragments = _fragments.get(key)
+    if fragments is None:
+      arch = self.archetypes[row]
+      fragments = {}
+      for attr, field in SHEET_FIELDS:
+        value = getattr(arch, field)
+        if value is None:
+          value = []
+        elif isinstance(value, basestring):
+          value = [value]
+        items = ["({a}) {it}".format(a=arch.name, it=it) for it in value]
+        fragments[attr] = sorted(
+            (it, format_item(it, width=width)) for it in items)
+      _fragments.put(key, fragments)
+    return fragments
+
+  def reusable_archetypes(self):
+    return dict(zip(self.archetype_digests, self.archetypes))
+
+  def reusable_techniques(self):
+    return dict(zip(self.technique_digests, self.techniques))
+
+
+class _CatalogAttribute(object):
+  # Exposes a field of the current catalog as a class attribute, loading the
+  # catalog on first access rather than at import.
+
+  def __init__(self, name):
+    self.name = name
+
+  def __get__(self, obj, owner):
+    return getattr(current_catalog(), self.name)
 
 
 class Character(object):
     
-  ARCHETYPES = read_archetypes()
-  TECHNIQUES = read_techniques()
+  ARCHETYPES = _CatalogAttribute("archetypes")
+  TECHNIQUES = _CatalogAttribute("techniques")
   
-  def __init__(self, *arch_names):
-    self._determine_archetypes(arch_names)
-    self._calculate_abilities()
-    self.specialties = self._flatten("specialty")
-    self.training = self._flatten("training")
-    self.traits = self._flatten("traits")
-    self.resources = self._flatten("resources")
-    self.techniques = self._flatten("techniques")
-    self.bonds = self._flatten("bond")
-    self.special_rules = self._flatten("special_rules")
-    self.power_level = sum([a.power_level for a in self.archetypes])
-    self.legal = (
-      sum([a.is_order for a in self.archetypes]) <= 1 and
-      len(self.archetypes) <= 4 and
-      len(self.archetypes) >=2)
+  def __init__(self, *arch_names, **kwargs):
+    # Pass rng=random.Random(seed) to make random archetypes reproducible.
+    self.catalog = current_catalog()
+    self._build(self._determine_archetypes(
+        arch_names, kwargs.get("rng") or random.Random()))
+
+  @classmethod
+  def from_mask(cls, mask, catalog=None, ratings=None):
+    """Builds the character with the archetypes in mask. ratings, the
+    RATINGS index of each ability, may be given if already merged."""
+    character = cls.__new__(cls)
+    character.catalog = catalog or current_catalog()
+    character._build(mask, ratings)
+    return character
+
+  def _build(self, mask, ratings=None):
+    with timing.phase("build"):
+      self.mask = mask
+      self.archetypes = self.catalog.archetypes_of(self.mask)
+      self._calculate_abilities(ratings)
+      self._sheet = self._merge_fragments(WIDTH)
+      for attr, _ in SHEET_FIELDS:
+        setattr(self, attr, [it for it, _ in self._sheet[attr]])
+      self.power_level = self.catalog.power_level_of(self.mask)
+      self.legal = self.catalog.is_legal(self.mask)
   
   def __str__(self):
-    s = "\n".join(line for line in [
-        "ARCHETYPES: " + ", ".join([a.name for a in self.archetypes]),
-        "POWER LEVEL: {} plus raises".format(self.power_level),
-        "*** THIS IS NOT A LEGAL CHARACTER! ***" * (1 - self.legal),
-        "\nABILITIES:\n    " + "\n    ".join([
-            "{ab}: {rat}".format(ab=ab.rjust(10), rat=rat)
-            for ab, rat in sorted(self.abilities.items())]),
-        ("\nSPECIALTIES: (max of one per Ability)\n" + format_list(
-            self.specialties)) * min(len(self.specialties), 1),
-        ("\nTRAINING:\n" + format_list(self.training)) * min(len(
-            self.training), 1),
-        ("\nTRAITS:\n" + format_list(self.traits)) * min(len(
-            self.traits), 1),
-        "\nRESOURCES:\n" + format_list(self.resources),
-        ("\nTECHNIQUES:\n" + format_list(self.techniques)) * min(len(
-            self.techniques), 1),
-        "\nBOND RELATIONSHIPS:\n" + format_list(self.bonds),
-        ("\nSPECIAL RULES:\n" + format_list(self.special_rules)) * min(len(
-            self.special_rules), 1)
-        ] if line)
+    return self.render()
+
+  def render(self, width=WIDTH):
+    return "".join(self.iter_render(width))
+
+  def iter_render(self, width=WIDTH):
+    """Yields the character sheet section by section."""
+    sections = (section for section in self._sections(width) if section)
+    yield next(sections)
+    for section in sections:
+      yield "\n" + section
     if self.techniques:
-      s += (
-        "\n\n" + ("=" * 80) + "\n\nRELEVANT TECHNIQUES:\n\n" +
-        self.format_relevant_techniques())
-    return s
-  
-  def _determine_archetypes(self, arch_names,):
+      yield "\n\n" + ("=" * width) + "\n\nRELEVANT TECHNIQUES:\n\n"
+      yield self.format_relevant_techniques(width)
+
+  def _sections(self, width):
+    sheet = self._sheet if width == WIDTH else self._merge_fragments(width)
+
+    def entries(attr):
+      return "\n".join(wrapped for _, wrapped in sheet[attr])
+
+    yield "ARCHETYPES: " + ", ".join([a.name for a in self.archetypes])
+    yield "POWER LEVEL: {} plus raises".format(self.power_level)
+    yield "*** THIS IS NOT A LEGAL CHARACTER! ***" * (1 - self.legal)
+    yield "\nABILITIES:\n    " + "\n    ".join([
+        "{ab}: {rat}".format(ab=ab.rjust(10), rat=rat)
+        for ab, rat in sorted(self.abilities.items())])
+    if self.specialties:
+      yield "\nSPECIALTIES: (max of one per Ability)\n" + entries(
+          "specialties")
+    if self.training:
+      yield "\nTRAINING:\n" + entries("training")
+    if self.traits:
+      yield "\nTRAITS:\n" + entries("traits")
+    yield "\nRESOURCES:\n" + entries("resources")
+    if self.techniques:
+      yield "\nTECHNIQUES:\n" + entries("techniques")
+    yield "\nBOND RELATIONSHIPS:\n" + entries("bonds")
+    if self.special_rules:
+      yield "\nSPECIAL RULES:\n" + entries("special_rules")
+
+  def _determine_archetypes(self, arch_names, rng):
+    # Returns the bitmask of the chosen archetypes; repeated names collapse
+    # into the same bit.
+    mask = 0
     if arch_names:
-      archs_by_name = dict((a.name.lower(), a) for a in self.ARCHETYPES)
-      candidate_names = archs_by_name.keys()
-      normalized_names = set(
-          [best_guess(name, candidate_names) for name in arch_names])
-      self.archetypes = [archs_by_name[name] for name in normalized_names]
+      rows_by_name = self.catalog.rows_by_name
+      for name in self.catalog.name_index.resolve_all(arch_names):
+        mask |= 1 << rows_by_name[name]
     else:
-      n_arch = random.choice([2, 2, 3, 3, 3, 4])
-      random.shuffle(self.ARCHETYPES)
-      self.archetypes = self.ARCHETYPES[:n_arch]
+      n_arch = rng.choice([2, 2, 3, 3, 3, 4])
+      for row in rng.sample(xrange(len(self.catalog.archetypes)), n_arch):
+        mask |= 1 << row
+    return mask
   
-  def _flatten(self, field):
-    final = []
-    for l, a in [(getattr(a, field), a) for a in self.archetypes]:
-      if l is None:
-        continue
-      elif isinstance(l, basestring):
-        final.append("({a}) {it}".format(a=a.name, it=l))
-      else:
-        final += ["({a}) {it}".format(a=a.name, it=it) for it in l]
-    return sorted(final)
-
-  def _calculate_abilities(self):
-    ab_list = [
-        "Influence", "Logistics", "Medicine", "Perception", "Prowess",
-        "Speed", "Stealth", "Steel", "Survival", "Technology", "Vehicles"]
-    ranks = {"possibly 3d": 0, "3d": 1, "3d or 4d": 2, "4d": 3}
-    translate = {
-        ():                       "🎲🎲",
-        ("possibly 3d",):         "🎲🎲              or 🎲🎲🎲   +raise",
-        ("3d",):                  "🎲🎲🎲",
-        ("3d or 4d",):            "🎲🎲🎲            or 🎲🎲🎲🎲 +raise",
-        ("4d",):                  "🎲🎲🎲🎲",
-        ("3d", "3d"):             "🎲🎲🎲   +bonus   or 🎲🎲🎲🎲",
-        ("3d or 4d", "3d"):       "🎲🎲🎲   +bonus   or 🎲🎲🎲🎲",
-        ("3d or 4d", "3d or 4d"): "🎲🎲🎲   +bonus   or 🎲🎲🎲🎲",
-        ("4d", "3d"):             "🎲🎲🎲🎲 +bonus",
-        ("4d", "3d or 4d"):       "🎲🎲🎲🎲 +bonus",
-        ("4d", "4d"):             "🎲🎲🎲🎲 +bonus"}
-    self.abilities = {}
-    for ab in ab_list:
-      grants = [
-          a.abilities.get(ab)
-          for a in self.archetypes
-          if ab in a.abilities]
-      ranked = sorted([(ranks[g], g) for g in grants])[::-1]
-      top_two = tuple([r[1] for r in ranked][:2])
-      if len(top_two) == 2 and top_two[1] == "possibly 3d":
-        top_two = top_two[:1]
-      self.abilities[ab] = translate[top_two]
-
-  def format_relevant_techniques(self):
-    relevant = set()
-    for my_tech in self.techniques:
-      lowered = my_tech.lower()
-      for candidate in self.TECHNIQUES:
-        if candidate.split("\n")[0].strip().lower() in lowered:
-          relevant.add(candidate)
-    return "\n\n".join(sorted(relevant))
+  def _merge_fragments(self, width):
+    # k-way merge of the archetypes' presorted fragments for each list.
+    fragments = [
+        self.catalog.fragments(row, width) for row in iter_bits(self.mask)]
+    return dict(
+        (attr, list(heapq.merge(*[f[attr] for f in fragments])))
+        for attr, _ in SHEET_FIELDS)
+
+  def _calculate_abilities(self, ratings=None):
+    if ratings is None:
+      ratings = self.catalog.merged_ratings(list(iter_bits(self.mask)))
+    self.ratings = list(ratings)
+    self.abilities = dict(zip(ABILITIES, [RATINGS[r] for r in self.ratings]))
+
+  def relevant_techniques(self):
+    # Titles never contain newlines, so no match spans two techniques.
+    with timing.phase("techniques"):
+      return self.catalog.techniques_mentioned("\n".join(self.techniques))
+
+  def format_relevant_techniques(self, width=WIDTH):
+    return "\n\n".join(sorted(set(
+        t.render(width) for t in self.relevant_techniques())))
+
+  def to_dict(self):
+    """The character sheet as plain data, with abilities rated by
+    RATING_LABELS, for the JSON API."""
+    sheet = dict((attr, getattr(self, attr)) for attr, _ in SHEET_FIELDS)
+    sheet.update(
+        archetypes=[a.name for a in self.archetypes],
+        power_level=self.power_level,
+        legal=bool(self.legal),
+        abilities=dict(zip(
+            ABILITIES, [RATING_LABELS[r] for r in self.ratings])),
+        relevant_techniques=[
+            {"title": t.title, "text": t.body.strip()}
+            for t in self.relevant_techniques()])
+    return sheet
 
 
 # --------------------------------------------------------------------------- #
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import chargen
+
+
+# Recorded from the original line-by-line parser (every field of every
+# archetype) and from the sheets it rendered for every pair of archetypes.
+PARITY_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "testdata",
+    "chargen_parity.json")
+
+FIELDS = (
+    "name", "is_order", "requirements", "power_level", "abilities",
+    "specialty", "training", "traits", "resources", "techniques", "bond",
+    "special_rules", "raw_text")
+
+
+def _fields(arch):
+  # The fields as the recording stored them: JSON, with requirements sorted.
+  fields = dict((f, getattr(arch, f)) for f in FIELDS)
+  if fields["requirements"] is not None:
+    fields["requirements"] = sorted(fields["requirements"])
+  return json.loads(json.dumps(fields))
+
+
+class ParserParityTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    with open(PARITY_PATH) as f:
+      cls.recorded = json.load(f)
+    cls.catalog = chargen.load_catalog(path=None)
+
+  def test_fields_match_recording(self):
+    archetypes = chargen.parse_archetypes(
+        chargen._read_text(chargen.ARCHETYPES_PATH))
+    self.assertEqual(len(archetypes), len(self.recorded["archetypes"]))
+    for arch, expected in zip(archetypes, self.recorded["archetypes"]):
+      self.assertEqual(_fields(arch), expected, arch.name)
+
+  def test_sheets_match_recording(self):
+    n = len(self.catalog.archetypes)
+    sheets = {}
+    for i in xrange(n):
+      for j in xrange(i + 1, n):
+        ch = chargen.Character.from_mask((1 << i) | (1 << j), self.catalog)
+        key = ",".join(a.name for a in ch.archetypes).decode("utf-8")
+        sheets[key] = hashlib.sha1(ch.render()).hexdigest()
+    self.assertEqual(sheets, self.recorded["sheets"])
+
+
+def _typo(rng, name):
+  # name with one character deleted, doubled, replaced or swapped.
+  i = rng.randrange(len(name))
+  edit = rng.randrange(4)
+  if edit == 0:
+    return name[:i] + name[i + 1:]
+  if edit == 1:
+    return name[:i] + name[i] + name[i:]
+  if edit == 2:
+    return name[:i] + rng.choice("abcdefghijklmnopqrstuvwxyz ") + name[i + 1:]
+  return name[:i] + name[i + 1:i + 2] + name[i:i + 1] + name[i + 2:]
+
+
+class NameIndexTest(unittest.TestCase):
+  # NameIndex must resolve every query exactly as best_guess does.
+
+  @classmethod
+  def setUpClass(cls):
+    cls.names = [a.name.lower() for a in chargen.load_catalog().archetypes]
+    cls.index = chargen.NameIndex(cls.names)
+
+  def _check(self, queries):
+    for query in queries:
+      self.assertEqual(
+          self.index.resolve(query), chargen.best_guess(query, self.names),
+          query)
+
+  def test_prefixes(self):
+    self._check(
+        name[:i] for name in self.names for i in xrange(1, len(name) + 1))
+
+  def test_random_queries(self):
+    rng = random.Random(0)
+    letters = sorted(set("".join(self.names)))
+    queries = []
+    for _ in xrange(2000):
+      queries.append(_typo(rng, rng.choice(self.names)))
+      queries.append("".join(
+          rng.choice(letters) for _ in xrange(rng.randint(1, 12))))
+    self._check(q for q in queries if q)
+
+
+class ReloadTest(unittest.TestCase):
+  # Reloads from edited copies of the text sources.
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.saved = (
+        chargen.ARCHETYPES_PATH, chargen.TECHNIQUES_PATH, chargen._catalog)
+    for attr in ("ARCHETYPES_PATH", "TECHNIQUES_PATH"):
+      path = os.path.join(self.dir, os.path.basename(getattr(chargen, attr)))
+      shutil.copy(getattr(chargen, attr), path)
+      setattr(chargen, attr, path)
+    self.previous = chargen._catalog = chargen.load_catalog(path=None)
+
+  def tearDown(self):
+    (chargen.ARCHETYPES_PATH, chargen.TECHNIQUES_PATH,
+     chargen._catalog) = self.saved
+    shutil.rmtree(self.dir)
+
+  def _edit(self, fn):
+    with open(chargen.ARCHETYPES_PATH) as f:
+      text = f.read()
+    with open(chargen.ARCHETYPES_PATH, "w") as f:
+      f.write(fn(text))
+
+  def test_installs_valid_edit(self):
+    self._edit(lambda t: t.replace("power level 5", "power level 6", 1))
+    self.assertIs(chargen.reload_catalog(), True)
+    self.assertIsNot(chargen.current_catalog(), self.previous)
+
+  def test_reload_keeps_what_edits_leave_alone(self):
+    self._edit(lambda t: t.replace("power level 5", "power level 6", 1))
+    before = self.previous
+    edited = next(
+        i for i, a in enumerate(before.archetypes) if a.power_level == 5)
+    name_index, matcher = before.name_index, before.technique_matcher
+    self.assertIs(chargen.reload_catalog(), True)
+    after = chargen.current_catalog()
+    self.assertIs(after.name_index, name_index)
+    self.assertIs(after.technique_matcher, matcher)
+    others = [i for i in xrange(len(after.archetypes)) if i != edited][:2]
+    unchanged = (1 << others[0]) | (1 << others[1])
+    self.assertEqual(after.sheet_key(unchanged), before.sheet_key(unchanged))
+    changed = unchanged | (1 << edited)
+    self.assertNotEqual(after.sheet_key(changed), before.sheet_key(changed))
+    self.assertEqual(
+        chargen.Character.from_mask(changed, after).power_level,
+        chargen.Character.from_mask(changed, before).power_level + 1)
+
+  def test_keeps_previous_without_power_level(self):
+    self._edit(lambda t: t.replace("power level 5", "powr level 5", 1))
+    self.assertIsNone(chargen.reload_catalog())
+    self.assertIs(chargen.current_catalog(), self.previous)
+
+  def test_keeps_previous_without_name(self):
+    self._edit(lambda t: t + "\n\n")
+    self.assertIsNone(chargen.reload_catalog())
+    self.assertIs(chargen.current_catalog(), self.previous)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import hashlib
+import json
+import multiprocessing
+import random
+import sys
+
+import vendored  # Puts lib/ on sys.path; keep it above click.
+
+import click
+
+import chargen
+import combos
+
+
+# --------------------------------------------------------------------------- #
+# Utilities.                                                                  #
+# --------------------------------------------------------------------------- #
+
+# Characters per task handed to a worker.
+CHUNK_SIZE = 500
+
+
+def character_seed(seed, k):
+  """Seed of the k-th character of a run seeded with seed.
+
+  Every character gets its own stream, so output does not depend on how
+  the run is split across workers.
+  """
+  digest = hashlib.sha1("{seed}:{k}".format(seed=seed, k=k)).hexdigest()
+  return int(digest[:16], 16)
+
+
+def _generate_chunk(task):
+  # Runs in a worker: returns characters start to stop of the run as text.
+  seed, start, stop, fmt, sampling = task
+  catalog = chargen.current_catalog()
+  sampler = combos.sampler_for(catalog)
+  masks = [
+      sampler.sample(rng=random.Random(character_seed(seed, k)), **sampling)
+      for k in xrange(start, stop)]
+  ratings = catalog.merged_ratings_batch(
+      list(chargen.iter_bits(mask)) for mask in masks)
+  out = []
+  for mask, merged in zip(masks, ratings):
+    ch = chargen.Character.from_mask(mask, catalog, merged)
+    if fmt == "jsonl":
+      out.append(json.dumps(ch.to_dict(), sort_keys=True) + "\n")
+    else:
+      out.append(ch.render() + "\n\n" + "=" * chargen.WIDTH + "\n\n")
+  return "".join(out)
+
+
+def _run(tasks, workers):
+  # Yields the results of the tasks in order, keeping at most two tasks per
+  # worker in flight so memory stays bounded however long the run is.
+  if workers == 1:
+    for task in tasks:
+      yield _generate_chunk(task)
+    return
+  pool = multiprocessing.Pool(workers)
+  try:
+    pending = collections.deque()
+    for task in tasks:
+      pending.append(pool.apply_async(_generate_chunk, (task,)))
+      if len(pending) >= 2 * workers:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+# --------------------------------------------------------------------------- #
+# Driver.                                                                     #
+# --------------------------------------------------------------------------- #
+
+@click.group()
+def cli():
+  """Exemplar character generator."""
+
+
+@cli.command()
+@click.argument("names", nargs=-1)
+def show(names):
+  """Print one character, random unless archetype NAMES are given."""
+  click.echo(str(chargen.Character(*names)))
+
+
+@cli.command()
+@click.option("--count", "-n", default=1, type=click.IntRange(min=1),
+              help="Number of characters.")
+@click.option("--workers", "-w", default=None, type=click.IntRange(min=1),
+              help="Worker processes (default: one per CPU).")
+@click.option("--format", "fmt", default="jsonl",
+              type=click.Choice(["jsonl", "text"]))
+@click.option("--seed", default=None, type=int,
+              help="Makes the run reproducible.")
+@click.option("--archetypes", default=None, type=int,
+              help="Number of archetypes per character.")
+@click.option("--min-power", default=None, type=int)
+@click.option("--max-power", default=None, type=int)
+def generate(count, workers, fmt, seed, archetypes, min_power, max_power):
+  """Write COUNT random characters to standard output."""
+  if seed is None:
+    seed = random.getrandbits(32)
+  sampling = dict(
+      sizes=[archetypes] if archetypes is not None else None,
+      min_power=min_power, max_power=max_power)
+  # Loaded before the pool starts, so forked workers inherit this catalog;
+  # also surfaces bad limits before any work is farmed out.
+  try:
+    combos.sampler_for(chargen.current_catalog()).sample(**sampling)
+  except ValueError as e:
+    raise click.UsageError(str(e))
+  click.echo("Seed {}".format(seed), err=True)
+  tasks = (
+      (seed, start, min(start + CHUNK_SIZE, count), fmt, sampling)
+      for start in xrange(0, count, CHUNK_SIZE))
+  workers = workers or multiprocessing.cpu_count()
+  with click.progressbar(length=count, file=sys.stderr) as bar:
+    for i, text in enumerate(_run(tasks, workers)):
+      sys.stdout.write(text)
+      bar.update(min(CHUNK_SIZE, count - i * CHUNK_SIZE))
+
+
+if __name__ == "__main__":
+  cli()
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+import array
+import marshal
+import multiprocessing
+import random
+import sys
+
+import chargen
+import metrics
+
+
+# --------------------------------------------------------------------------- #
+# Utilities.                                                                  #
+# --------------------------------------------------------------------------- #
+
+COMBOS_PATH = "combos.bin"
+
+# Bump whenever the on-disk layout of the table changes.
+COMBOS_FORMAT = 1
+
+MIN_SIZE = 2
+MAX_SIZE = 4
+
+# Pads the member columns of combinations smaller than MAX_SIZE.
+NO_MEMBER = 255
+
+# Relative odds of each size for random characters, matching the historical
+# choice among [2, 2, 3, 3, 3, 4].
+SIZE_WEIGHTS = {2: 2, 3: 3, 4: 1}
+
+_draws = metrics.REGISTRY.counter(
+    "exemplar_sampler_draws_total",
+    "Random characters drawn; each draw is one pass, with no rejections.")
+
+_N_GRANTS = len(chargen.GRANTS)
+
+# Folds one more grant code into the (top, second) pair of grant codes seen
+# so far, both packed as top * _N_GRANTS + second like chargen.MERGE_TABLE.
+_STEP = array.array("B", [
+    max(top, code) * _N_GRANTS + max(second, min(top, code))
+    for top in range(_N_GRANTS)
+    for second in range(_N_GRANTS)
+    for code in range(_N_GRANTS)])
+
+
+def _choose(n, k):
+  result = 1
+  for i in xrange(k):
+    result = result * (n - i) // (i + 1)
+  return result
+
+
+def _build_shard(first):
+  """Returns the packed table columns for every legal combination whose
+  lowest catalog row is first."""
+  catalog = chargen.current_catalog()
+  n = len(catalog.archetypes)
+  width = len(chargen.ABILITIES)
+  grants = catalog.ability_matrix
+  codes = [tuple(grants[r * width:(r + 1) * width]) for r in xrange(n)]
+  levels = catalog.power_levels
+  orders = [(catalog.order_mask >> r) & 1 for r in xrange(n)]
+  merge, step = chargen.MERGE_TABLE, _STEP
+
+  members_col = array.array("B")
+  levels_col = array.array("B")
+  orders_col = array.array("B")
+  abilities_col = array.array("B")
+
+  def visit(members, state, level, n_orders):
+    if len(members) >= MIN_SIZE:
+      members_col.extend(members + [NO_MEMBER] * (MAX_SIZE - len(members)))
+      levels_col.append(level)
+      orders_col.append(n_orders)
+      abilities_col.extend([merge[s] for s in state])
+    if len(members) == MAX_SIZE:
+      return
+    for r in xrange(members[-1] + 1, n):
+      if n_orders + orders[r] > 1:
+        continue
+      visit(
+          members + [r],
+          tuple([step[s * _N_GRANTS + c] for s, c in zip(state, codes[r])]),
+          level + levels[r], n_orders + orders[r])
+
+  visit([first], tuple([step[c] for c in codes[first]]), levels[first],
+        orders[first])
+  return (
+      members_col.tostring(), levels_col.tostring(), orders_col.tostring(),
+      abilities_col.tostring())
+
+
+# --------------------------------------------------------------------------- #
+# Main classes.                                                               #
+# --------------------------------------------------------------------------- #
+
+class ComboTable(object):
+  """Every legal combination of MIN_SIZE to MAX_SIZE archetypes.
+
+  Rows are stored column-wise in flat byte arrays: MAX_SIZE catalog rows per
+  combination (padded with NO_MEMBER), its power level, its count of
+  exemplar orders, and the chargen.RATINGS index of each of the abilities.
+  Questions about the whole space of characters are scans of these columns.
+  """
+
+  def __init__(self, version, members, power_levels, orders, abilities):
+    self.version = version
+    self.members = members
+    self.power_levels = power_levels
+    self.orders = orders
+    self.abilities = abilities
+
+  @classmethod
+  def build(cls, workers=None):
+    """Enumerates the table for the current catalog with a process pool, one
+    shard per first archetype."""
+    # Loaded before the pool starts, so forked workers inherit this catalog.
+    catalog = chargen.current_catalog()
+    n = len(catalog.archetypes)
+    if n > NO_MEMBER:
+      raise ValueError("Too many archetypes for the combination table.")
+    if workers == 1:
+      shards = [_build_shard(first) for first in xrange(n)]
+    else:
+      pool = multiprocessing.Pool(workers)
+      try:
+        shards = pool.map(_build_shard, xrange(n), chunksize=1)
+      finally:
+        pool.close()
+        pool.join()
+    columns = [array.array("B") for _ in xrange(4)]
+    for shard in shards:
+      for column, packed in zip(columns, shard):
+        column.fromstring(packed)
+    return cls(catalog.version, *columns)
+
+  @classmethod
+  def load(cls, path=COMBOS_PATH, catalog=None):
+    """Loads a table saved for the given catalog, or returns None if the file
+    is missing or was built from a different catalog."""
+    catalog = catalog or chargen.current_catalog()
+    try:
+      with open(path, "rb") as f:
+        saved = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+      return None
+    if (saved.get("format") != COMBOS_FORMAT or
+        saved.get("version") != catalog.version):
+      return None
+    columns = []
+    for name in ("members", "power_levels", "orders", "abilities"):
+      column = array.array("B")
+      column.fromstring(saved[name])
+      columns.append(column)
+    return cls(catalog.version, *columns)
+
+  def save(self, path=COMBOS_PATH):
+    with open(path, "wb") as f:
+      marshal.dump({
+          "format": COMBOS_FORMAT,
+          "version": self.version,
+          "members": self.members.tostring(),
+          "power_levels": self.power_levels.tostring(),
+          "orders": self.orders.tostring(),
+          "abilities": self.abilities.tostring()}, f, 2)
+
+  def __len__(self):
+    return len(self.power_levels)
+
+  def rows_of(self, i):
+    return [
+        r for r in self.members[i * MAX_SIZE:(i + 1) * MAX_SIZE]
+        if r != NO_MEMBER]
+
+  def mask(self, i):
+    mask = 0
+    for r in self.rows_of(i):
+      mask |= 1 << r
+    return mask
+
+  def ratings(self, i):
+    width = len(chargen.ABILITIES)
+    return self.abilities[i * width:(i + 1) * width].tolist()
+
+  def ability_column(self, ability):
+    width = len(chargen.ABILITIES)
+    return self.abilities[chargen.ABILITIES.index(ability)::width]
+
+  def where(self, power_level=None, ratings=None):
+    """Yields the indices of the rows with the given power level and, for
+    every (ability, RATINGS index) pair in ratings, that rating."""
+    checks = [
+        (self.ability_column(ability), rating)
+        for ability, rating in (ratings or {}).items()]
+    if power_level is not None:
+      checks.append((self.power_levels, power_level))
+    for i in xrange(len(self)):
+      if all(column[i] == value for column, value in checks):
+        yield i
+
+  def count(self, power_level=None, ratings=None):
+    ratings = ratings or {}
+    if not ratings:
+      return (
+          len(self) if power_level is None
+          else self.power_levels.count(power_level))
+    elif power_level is None and len(ratings) == 1:
+      (ability, rating), = ratings.items()
+      return self.ability_column(ability).count(rating)
+    return sum(1 for _ in self.where(power_level, ratings))
+
+
+class Sampler(object):
+  """Draws random legal characters in one pass, without rejection.
+
+  ways[i] maps (size, orders, power level) to the number of subsets of
+  catalog rows i and up with those totals and at most one exemplar order.
+  sample() first picks the totals, weighted by how many characters have
+  them, then walks the rows once, taking each with the exact probability
+  that a uniformly chosen subset with those totals contains it.
+  """
+
+  def __init__(self, catalog):
+    self.version = catalog.version
+    self.levels = catalog.power_levels
+    self.orders = [
+        (catalog.order_mask >> r) & 1 for r in xrange(len(self.levels))]
+    ways = [{(0, 0, 0): 1}]
+    for r in reversed(xrange(len(self.levels))):
+      after = ways[-1]
+      here = dict(after)
+      for (size, n_orders, level), count in after.iteritems():
+        key = (
+            size + 1, n_orders + self.orders[r], level + self.levels[r])
+        if key[0] <= MAX_SIZE and key[1] <= 1:
+          here[key] = here.get(key, 0) + count
+      ways.append(here)
+    self.ways = ways[::-1]
+
+  def _targets(self, sizes, min_power, max_power):
+    # Returns [(totals, weight)] for the totals allowed by the query. Unless
+    # a size is requested, sizes are weighted as SIZE_WEIGHTS and characters
+    # are uniform within a size.
+    n = len(self.levels)
+    targets = []
+    for totals, count in sorted(self.ways[0].iteritems()):
+      size, _, level = totals
+      if ((size in sizes if sizes else size in SIZE_WEIGHTS) and
+          (min_power is None or level >= min_power) and
+          (max_power is None or level <= max_power)):
+        weight = count if sizes else (
+            float(count) * SIZE_WEIGHTS[size] / _choose(n, size))
+        targets.append((totals, weight))
+    return targets
+
+  def count(self, sizes=None, min_power=None, max_power=None):
+    """Number of legal characters matching the query."""
+    return sum(
+        self.ways[0][totals]
+        for totals, _ in self._targets(sizes, min_power, max_power))
+
+  def sample(self, rng=random, sizes=None, min_power=None, max_power=None):
+    """Returns the bitmask of a random legal character with one of the given
+    sizes and a power level in [min_power, max_power]."""
+    if sizes and not set(sizes) <= set(SIZE_WEIGHTS):
+      raise ValueError("Characters have {lo} to {hi} archetypes.".format(
+          lo=MIN_SIZE, hi=MAX_SIZE))
+    targets = self._targets(sizes, min_power, max_power)
+    if not targets:
+      raise ValueError("No legal character matches those limits.")
+    pick = rng.random() * sum(weight for _, weight in targets)
+    for totals, weight in targets:
+      pick -= weight
+      if pick < 0:
+        break
+    _draws.inc()
+    size, n_orders, level = totals
+    mask = 0
+    for r in xrange(len(self.levels)):
+      if not size:
+        break
+      rest = (size - 1, n_orders - self.orders[r], level - self.levels[r])
+      taking = self.ways[r + 1].get(rest, 0)
+      if taking and rng.random() * self.ways[r][size, n_orders, level] < taking:
+        mask |= 1 << r
+        size, n_orders, level = rest
+    return mask
+
+
+_sampler = None
+
+
+def sampler_for(catalog):
+  """Returns a Sampler for catalog, reusing the last one built for it."""
+  global _sampler
+  sampler = _sampler
+  if sampler is None or sampler.version != catalog.version:
+    sampler = _sampler = Sampler(catalog)
+  return sampler
+
+
+# --------------------------------------------------------------------------- #
+# Driver.                                                                     #
+# --------------------------------------------------------------------------- #
+
+def _parse_criteria(args):
+  # "power_level=12" and "<Ability>=<rating label>", e.g. "Prowess=4d".
+  power_level, ratings = None, {}
+  for arg in args:
+    key, _, value = arg.partition("=")
+    if key == "power_level":
+      power_level = int(value)
+    else:
+      ratings[key.capitalize()] = chargen.RATING_LABELS.index(value)
+  return power_level, ratings
+
+
+def main(argv):
+  command, args = (argv[0], argv[1:]) if argv else ("count", [])
+  if command == "build":
+    table = ComboTable.build()
+    table.save()
+    print "Wrote {n} combinations to {path}.".format(
+        n=len(table), path=COMBOS_PATH)
+    return
+  table = ComboTable.load()
+  if table is None:
+    sys.exit("{path} is missing or stale; run 'combos.py build'.".format(
+        path=COMBOS_PATH))
+  power_level, ratings = _parse_criteria(args)
+  if command == "count":
+    print table.count(power_level, ratings)
+  elif command == "list":
+    catalog = chargen.current_catalog()
+    for i in table.where(power_level, ratings):
+      print ", ".join(a.name for a in catalog.archetypes_of(table.mask(i)))
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
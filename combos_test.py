@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import itertools
+import random
+import unittest
+
+import chargen
+import combos
+
+
+# Ten ordinary archetypes and five exemplar orders, few enough to enumerate.
+SMALL_ROWS = range(10) + range(57, 62)
+
+QUERIES = [
+    dict(sizes=sizes, min_power=lo, max_power=hi)
+    for sizes in (None, [2], [3], [4], [2, 4])
+    for lo, hi in ((None, None), (7, 20), (10, 12), (None, 6), (18, None))]
+
+
+def _small_catalog():
+  catalog = chargen.current_catalog()
+  return chargen.Catalog(
+      [catalog.archetypes[r] for r in SMALL_ROWS], catalog.techniques,
+      "small", ([catalog.archetype_digests[r] for r in SMALL_ROWS],
+                catalog.technique_digests))
+
+
+def _enumerate(catalog, sizes=None, min_power=None, max_power=None):
+  # Every legal mask matching the query, the slow way.
+  n = len(catalog.archetypes)
+  masks = []
+  for size in sizes or combos.SIZE_WEIGHTS:
+    for rows in itertools.combinations(xrange(n), size):
+      mask = sum(1 << r for r in rows)
+      level = catalog.power_level_of(mask)
+      if (catalog.is_legal(mask) and
+          (min_power is None or level >= min_power) and
+          (max_power is None or level <= max_power)):
+        masks.append(mask)
+  return masks
+
+
+class SamplerTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.catalog = _small_catalog()
+    cls.sampler = combos.Sampler(cls.catalog)
+
+  def test_count_matches_enumeration(self):
+    for query in QUERIES:
+      self.assertEqual(
+          self.sampler.count(**query), len(_enumerate(self.catalog, **query)),
+          query)
+
+  def test_samples_are_legal_and_within_limits(self):
+    catalog = chargen.current_catalog()
+    sampler = combos.sampler_for(catalog)
+    rng = random.Random(1)
+    for query in QUERIES:
+      if not sampler.count(**query):
+        self.assertRaises(ValueError, sampler.sample, **query)
+        continue
+      for _ in xrange(200):
+        mask = sampler.sample(rng=rng, **query)
+        level = catalog.power_level_of(mask)
+        self.assertTrue(catalog.is_legal(mask), query)
+        self.assertIn(chargen.popcount(mask), query["sizes"] or [2, 3, 4])
+        self.assertTrue(
+            query["min_power"] is None or level >= query["min_power"], query)
+        self.assertTrue(
+            query["max_power"] is None or level <= query["max_power"], query)
+
+  def test_samples_are_uniform_within_a_size(self):
+    legal = _enumerate(self.catalog, sizes=[2])
+    draws = 200 * len(legal)
+    rng = random.Random(2)
+    counts = collections.Counter(
+        self.sampler.sample(rng=rng, sizes=[2]) for _ in xrange(draws))
+    self.assertEqual(set(counts), set(legal))
+    for mask in legal:
+      self.assertLess(abs(counts[mask] - 200), 60, bin(mask))
+
+  def test_sizes_follow_weights(self):
+    # As if a size were drawn by SIZE_WEIGHTS, then archetypes uniformly,
+    # redrawing illegal characters.
+    rows = len(self.catalog.archetypes)
+    odds = dict(
+        (size, float(weight) * len(_enumerate(self.catalog, sizes=[size])) /
+         combos._choose(rows, size))
+        for size, weight in combos.SIZE_WEIGHTS.items())
+    n = 10000
+    rng = random.Random(3)
+    sizes = collections.Counter(
+        chargen.popcount(self.sampler.sample(rng=rng)) for _ in xrange(n))
+    for size, weight in odds.items():
+      self.assertAlmostEqual(
+          float(sizes[size]) / n, weight / sum(odds.values()), delta=0.02)
+
+  def test_impossible_limits_raise(self):
+    with self.assertRaises(ValueError):
+      self.sampler.sample(min_power=100)
+    with self.assertRaises(ValueError):
+      self.sampler.sample(sizes=[5])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+
+
+class LRUCache(object):
+  """A thread-safe least-recently-used mapping with hit and miss counters.
+
+  Holds at most maxsize entries and, when maxbytes is given, evicts until the
+  values total at most maxbytes as measured by sizeof. Values larger than
+  maxbytes on their own are never stored.
+  """
+
+  def __init__(self, maxsize=1024, maxbytes=None, sizeof=len):
+    self.maxsize = maxsize
+    self.maxbytes = maxbytes
+    self.sizeof = sizeof
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        entry = self._entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      self._entries[key] = entry
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, value):
+    size = self.sizeof(value) if self.maxbytes is not None else 0
+    if self.maxbytes is not None and size > self.maxbytes:
+      return
+    with self._lock:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self.nbytes -= old[1]
+      self._entries[key] = (value, size)
+      self.nbytes += size
+      while (len(self._entries) > self.maxsize or
+             (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+        _, (_, evicted) = self._entries.popitem(last=False)
+        self.nbytes -= evicted
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.nbytes = 0
@@ -1,10 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+import hashlib
+import hmac
+import itertools
 import logging
+import os
+import pstats
+import random
+import timeit
+import urllib
 
 import chargen
+import combos
+import lru
+import metrics
+import profiling
+import timing
 
+from flask import abort
 from flask import Flask
+from flask import g
+from flask import json
+from flask import jsonify
 from flask import request
 from flask import Response
 
@@ -12,6 +30,92 @@ from flask import Response
 app = Flask(__name__)
 
 
+_requests = metrics.REGISTRY.counter(
+    "exemplar_requests_total", "Requests served, by route and status.",
+    ("route", "method", "status"))
+_latency = metrics.REGISTRY.histogram(
+    "exemplar_request_duration_seconds",
+    "Time from the start of a request until its response is closed.",
+    ("route",))
+
+
+@app.before_request
+def start_request_metrics():
+  g.request_start = timeit.default_timer()
+
+
+@app.after_request
+def record_request_metrics(response):
+  # Requests that never reached start_request_metrics, e.g. because a hook
+  # registered before it answered first, are counted but not timed.
+  route = request.url_rule.rule if request.url_rule else "(unmatched)"
+  start = g.get("request_start")
+  _requests.inc((route, request.method, str(response.status_code)))
+  if start is not None:
+    response.call_on_close(
+        lambda: _latency.observe(timeit.default_timer() - start, (route,)))
+  return response
+
+
+# Set EXEMPLAR_WATCH_CATALOG (e.g. under env_variables in a staging app.yaml)
+# to pick up edits to archetypes.txt and techniques.txt without a restart.
+if os.environ.get("EXEMPLAR_WATCH_CATALOG"):
+  @app.before_request
+  def watch_catalog():
+    chargen.maybe_reload_catalog()
+
+
+# Set EXEMPLAR_TIMING to time the phases of each request (see timing.py),
+# reported in a Server-Timing header and one structured log line per request.
+# Streamed bodies are then rendered before the headers go out, so that the
+# header covers them.
+if timing.ENABLED:
+  @app.before_request
+  def begin_timing():
+    timing.begin()
+
+  @app.after_request
+  def report_timing(response):
+    if response.is_streamed:
+      response.make_sequence()
+    phases, total = timing.end()
+    response.headers["Server-Timing"] = timing.server_timing(phases, total)
+    record = {
+        "path": request.path,
+        "route": request.url_rule.rule if request.url_rule else None,
+        "status": response.status_code,
+        "phases_ms": dict(
+            (name, round(seconds * 1000, 3))
+            for name, seconds in phases.iteritems()),
+        "total_ms": round(total * 1000, 3)}
+    response.call_on_close(
+        lambda: logging.info("timing %s", json.dumps(record)))
+    return response
+
+
+# Set EXEMPLAR_PROFILE_EVERY=N to profile one request in N, and/or
+# EXEMPLAR_PROFILE_PATHS to a regular expression for paths to always profile.
+# Aggregates are logged (or written under EXEMPLAR_PROFILE_DIR) every
+# EXEMPLAR_PROFILE_INTERVAL seconds and shown at /admin/profile.
+profiler = None
+if (os.environ.get("EXEMPLAR_PROFILE_EVERY") or
+    os.environ.get("EXEMPLAR_PROFILE_PATHS")):
+  profiler = app.wsgi_app = profiling.SampledProfilerMiddleware(
+      app.wsgi_app, app.url_map,
+      every=int(os.environ.get("EXEMPLAR_PROFILE_EVERY", 0)),
+      paths=os.environ.get("EXEMPLAR_PROFILE_PATHS"),
+      dump_dir=os.environ.get("EXEMPLAR_PROFILE_DIR"),
+      dump_interval=int(os.environ.get("EXEMPLAR_PROFILE_INTERVAL", 600)))
+
+# Set EXEMPLAR_STACK_SAMPLER to install the stack sampler, idle until started
+# from /admin/sampler/start. It samples from a background thread, which App
+# Engine only allows on manually scaled instances, so it is for local runs
+# and manual scaling; leave it unset on automatically scaled versions.
+sampler = None
+if os.environ.get("EXEMPLAR_STACK_SAMPLER"):
+  sampler = app.wsgi_app = profiling.SamplingProfilerMiddleware(app.wsgi_app)
+
+
 EXPLANATORY = "\n\n" + """
 ===============================================================================
 
@@ -54,47 +158,424 @@ Overlapping grants of character attributes are handled as follows:
 """
 
 
+# Responses that depend only on the catalog and the code carry both as a
+# validator: the strong ETag hashes the content hash of archetypes.txt and
+# techniques.txt with the version of the code rendering them.
+CATALOG_MAX_AGE = 300
+
+_SOURCES = [
+    os.path.splitext(path)[0] + ".py"
+    for path in (chargen.__file__, combos.__file__, __file__)]
+
+
+def _code_version():
+  # App Engine names each deployed version; elsewhere hash the sources.
+  version = os.environ.get("CURRENT_VERSION_ID")
+  if version:
+    return version
+  digest = hashlib.sha1()
+  for path in _SOURCES:
+    with open(path, "rb") as f:
+      digest.update(f.read())
+  return digest.hexdigest()
+
+
+CODE_VERSION = _code_version()
+CODE_MODIFIED = max(os.path.getmtime(path) for path in _SOURCES)
+
+
+def _etag(catalog):
+  return hashlib.sha1(CODE_VERSION + catalog.version).hexdigest()
+
+
+def _abort_if_not_modified(catalog):
+  # Answers 304 when the client's copy is still current. Call it only once
+  # the request is known to succeed.
+  if request.if_none_match:
+    current = request.if_none_match.contains(_etag(catalog))
+  else:
+    since = request.if_modified_since
+    current = bool(since and catalog.modified and
+                   since >= _last_modified(catalog))
+  if current:
+    abort(_validated(Response(status=304), catalog))
+
+
+def _last_modified(catalog):
+  return datetime.datetime.utcfromtimestamp(
+      int(max(catalog.modified, CODE_MODIFIED)))
+
+
+def _validated(response, catalog):
+  response.set_etag(_etag(catalog))
+  if catalog.modified:
+    response.last_modified = _last_modified(catalog)
+  response.cache_control.public = True
+  response.cache_control.max_age = CATALOG_MAX_AGE
+  return response
+
+
+def _width():
+  # Optional ?width= for narrow clients, clamped to a readable range.
+  return max(40, min(200, request.args.get("width", chargen.WIDTH, type=int)))
+
+
+def _permalink(seed):
+  args = dict(request.args.items())
+  args["seed"] = seed
+  return "{url}?{query}".format(
+      url=request.base_url, query=urllib.urlencode(sorted(args.items())))
+
+
+def _int_arg(name, default=None):
+  # Like request.args.get(name, default, type=int), but raises ValueError
+  # for a value that is not an integer rather than ignoring it.
+  value = request.args.get(name)
+  if value is None:
+    return default
+  try:
+    return int(value)
+  except ValueError:
+    raise ValueError("{name} must be an integer.".format(name=name))
+
+
+def _sampling_args():
+  # The random-character query parameters shared by / and the JSON API.
+  # Raises ValueError for malformed values and limits no character could
+  # meet.
+  n_archetypes = _int_arg("archetypes")
+  min_power = _int_arg("min_power", 7)
+  max_power = _int_arg("max_power", 20)
+  if n_archetypes is not None and n_archetypes not in combos.SIZE_WEIGHTS:
+    raise ValueError("Characters have {lo} to {hi} archetypes.".format(
+        lo=combos.MIN_SIZE, hi=combos.MAX_SIZE))
+  if min_power > max_power:
+    raise ValueError(
+        "min_power ({lo}) is greater than max_power ({hi}{default}).".format(
+            lo=min_power, hi=max_power,
+            default="" if "max_power" in request.args else ", the default"))
+  return dict(
+      sizes=[n_archetypes] if n_archetypes is not None else None,
+      min_power=min_power, max_power=max_power)
+
+
+def _sample(catalog, n, error):
+  # Draws n random characters' masks, in order from one generator seeded
+  # with ?seed= or else a fresh seed, under _sampling_args(). Returns (seed,
+  # seeded, masks); answers bad parameters and impossible limits with
+  # error(message, status).
+  try:
+    seed = _int_arg("seed")
+    args = _sampling_args()
+  except ValueError as e:
+    abort(error(str(e), 400))
+  seeded = seed is not None
+  if not seeded:
+    seed = random.getrandbits(32)
+  rng = random.Random(seed)
+  sampler = combos.sampler_for(catalog)
+  try:
+    with timing.phase("sample"):
+      masks = [sampler.sample(rng=rng, **args) for _ in xrange(n)]
+  except ValueError as e:
+    abort(error(str(e), 404))
+  if seeded:
+    _abort_if_not_modified(catalog)
+  return seed, seeded, masks
+
+
+def _text_error(message, status):
+  return Response(message, status=status, mimetype="text/plain")
+
+
+def _stream(chunks, cache_key=None):
+  # Passes the chunks through to the client and, given a key, caches the
+  # complete body once the last chunk has gone out.
+  sent = [] if cache_key is not None else None
+  for chunk in timing.timed("render", chunks):
+    if sent is not None:
+      sent.append(chunk)
+    yield chunk
+  if sent is not None:
+    rendered_characters.put(cache_key, "".join(sent))
+
+
 @app.route('/')
 def random_character():
-  accept = False
-  while not accept:
-    ch = chargen.Character()
-    accept = ch.legal and ch.power_level >= 7 and ch.power_level <= 20
-  text = "{}{}".format(ch, EXPLANATORY)
-  return Response(text, mimetype="text/plain; charset=unicode")
+  # Optional query parameters: min_power and max_power (default 7 and 20),
+  # archetypes, the number of archetypes, width and seed. A given seed and
+  # set of parameters always yields the same character for the same catalog.
+  catalog = chargen.current_catalog()
+  seed, seeded, (mask,) = _sample(catalog, 1, _text_error)
+  ch = chargen.Character.from_mask(mask, catalog)
+  chunks = itertools.chain(
+      ch.iter_render(_width()),
+      ["\n\nPERMALINK: {}".format(_permalink(seed)), EXPLANATORY])
+  response = Response(
+      _stream(chunks), mimetype="text/plain; charset=unicode")
+  return _validated(response, catalog) if seeded else response
+
+
+def _format_listing(archetypes):
+  return "\n".join([
+    "Power Level {}".format(a.power_level).ljust(20) + a.name
+    for a in archetypes])
+
+
+# (catalog version, /list body), rebuilt when the catalog changes.
+_listing = (None, None)
 
 
 @app.route('/list')
 def list_archetypes():
-  sorted_archs = sorted(
-      chargen.Character.ARCHETYPES,
-      key=lambda a: (a.power_level, a.name))
-  text = "\n".join([
-    "Power Level {}".format(a.power_level).ljust(20) + a.name
-    for a in sorted_archs])
-  return Response(text, mimetype="text/plain")
+  global _listing
+  catalog = chargen.current_catalog()
+  _abort_if_not_modified(catalog)
+  version, text = _listing
+  if version != catalog.version:
+    text = _format_listing(catalog.listing)
+    _listing = (catalog.version, text)
+  return _validated(Response(text, mimetype="text/plain"), catalog)
 
 
 @app.route('/search/<path:query>')
 def search_archetypes(query):
-  sorted_archs = sorted(
-      chargen.Character.ARCHETYPES,
-      key=lambda a: (a.power_level, a.name))
-  matches = [a for a in sorted_archs if query.lower() in a.raw_text]
-  header = "{n} archetypes contain the string '{q}'.\n\n".format(
-      n=len(matches), q=query)
-  text = header + "\n".join([
-    "Power Level {}".format(a.power_level).ljust(20) + a.name
-    for a in matches])
-  return Response(text, mimetype="text/plain")
+  # Archetypes whose text contains query and every ?and= term, as in
+  # /search/armor?and=steel. Quoted terms match whole words, others match
+  # anywhere. Commas are part of a term, since the text is full of them.
+  terms = [query] + [t for t in request.args.getlist("and") if t]
+  terms = [t.encode("utf-8") for t in terms]
+  catalog = chargen.current_catalog()
+  _abort_if_not_modified(catalog)
+  matches = catalog.search(terms)
+  header = (
+      "{n} archetypes contain the string {q}.\n\n" if len(terms) == 1
+      else "{n} archetypes match all of {q}.\n\n").format(
+          n=len(matches), q=", ".join("'{}'".format(t) for t in terms))
+  text = header + _format_listing(matches)
+  return _validated(Response(text, mimetype="text/plain"), catalog)
+
+
+@app.route('/technique/<path:name>')
+def technique(name):
+  # The catalog holds UTF-8 byte strings; match and quote the name as one.
+  name = name.encode("utf-8")
+  catalog = chargen.current_catalog()
+  exact = catalog.technique_map.get(name.strip().lower())
+  found = [exact] if exact else catalog.techniques_mentioned(name)
+  if not found:
+    return _text_error("No technique is named '{}'.".format(name), 404)
+  _abort_if_not_modified(catalog)
+  width = _width()
+  text = "\n\n".join(sorted(set(t.render(width) for t in found)))
+  return _validated(Response(text, mimetype="text/plain"), catalog)
+
+
+# --------------------------------------------------------------------------- #
+# JSON API.                                                                   #
+# --------------------------------------------------------------------------- #
+
+# Most characters one /api/characters request may ask for.
+MAX_BATCH = 1000
+
+
+def _json_error(message, status):
+  response = jsonify(error=message)
+  response.status_code = status
+  return response
+
+
+@app.route('/api/character')
+def api_random_character():
+  # The query parameters of /, less width.
+  catalog = chargen.current_catalog()
+  seed, seeded, (mask,) = _sample(catalog, 1, _json_error)
+  sheet = chargen.Character.from_mask(mask, catalog).to_dict()
+  with timing.phase("encode"):
+    response = jsonify(seed=seed, character=sheet)
+  return _validated(response, catalog) if seeded else response
+
+
+@app.route('/api/character/<path:archnames>')
+def api_character(archnames):
+  catalog = chargen.current_catalog()
+  try:
+    names = catalog.name_index.resolve_all(archnames.split(","))
+  except ValueError as e:
+    return _json_error(str(e), 400)
+  _abort_if_not_modified(catalog)
+  mask = sum(1 << catalog.rows_by_name[name] for name in set(names))
+  sheet = chargen.Character.from_mask(mask, catalog).to_dict()
+  with timing.phase("encode"):
+    response = jsonify(character=sheet)
+  return _validated(response, catalog)
+
+
+@app.route('/api/characters')
+def api_characters():
+  # n (default 1, at most MAX_BATCH) random characters, drawn in order from
+  # one generator seeded with seed, so a seeded batch is reproducible.
+  catalog = chargen.current_catalog()
+  try:
+    n = _int_arg("n", 1)
+  except ValueError as e:
+    return _json_error(str(e), 400)
+  if not 1 <= n <= MAX_BATCH:
+    return _json_error(
+        "n must be between 1 and {}.".format(MAX_BATCH), 400)
+  seed, seeded, masks = _sample(catalog, n, _json_error)
+  ratings = catalog.merged_ratings_batch(
+      list(chargen.iter_bits(mask)) for mask in masks)
+
+  def generate():
+    yield '{{"seed": {seed}, "characters": ['.format(seed=seed)
+    for i, (mask, merged) in enumerate(zip(masks, ratings)):
+      sheet = chargen.Character.from_mask(mask, catalog, merged).to_dict()
+      with timing.phase("encode"):
+        text = json.dumps(sheet)
+      yield ", " * (i > 0) + text
+    yield "]}"
+
+  response = Response(generate(), mimetype="application/json")
+  return _validated(response, catalog) if seeded else response
+
+
+# --------------------------------------------------------------------------- #
+# Named characters.                                                           #
+# --------------------------------------------------------------------------- #
+
+# Rendered /<archnames> responses, keyed by width and Catalog.sheet_key, since
+# nothing else affects the output. Entries whose blocks a reload leaves alone
+# stay valid; the rest age out.
+rendered_characters = lru.LRUCache(maxsize=4096, maxbytes=32 * 1024 * 1024)
 
 
 @app.route('/<path:archnames>')
 def character(archnames):
-  text = str(chargen.Character(*archnames.split(",")))  + EXPLANATORY
+  catalog = chargen.current_catalog()
+  try:
+    names = catalog.name_index.resolve_all(archnames.split(","))
+  except ValueError as e:
+    return _text_error(str(e), 400)
+  _abort_if_not_modified(catalog)
+  mask = sum(1 << catalog.rows_by_name[name] for name in set(names))
+  width = _width()
+  key = (width,) + catalog.sheet_key(mask)
+  text = rendered_characters.get(key)
+  if text is None:
+    text = _stream(itertools.chain(
+        chargen.Character.from_mask(mask, catalog).iter_render(width),
+        [EXPLANATORY]), key)
+  return _validated(Response(text, mimetype="text/plain"), catalog)
+
+
+# --------------------------------------------------------------------------- #
+# Administration.                                                             #
+# --------------------------------------------------------------------------- #
+
+def _require_admin():
+  # Admin routes exist only when EXEMPLAR_ADMIN_TOKEN is set, and then need
+  # it in an X-Admin-Token header.
+  token = os.environ.get("EXEMPLAR_ADMIN_TOKEN")
+  if not token:
+    abort(404)
+  given = request.headers.get("X-Admin-Token", "")
+  if not hmac.compare_digest(given.encode("utf-8"), token):
+    abort(403)
+
+
+@app.route('/admin/profile')
+def profile_report():
+  # Optional query parameters: route (a URL rule such as /list), sort (a
+  # pstats sort key, default cumulative) and lines.
+  _require_admin()
+  if profiler is None:
+    return Response(
+        "Profiling is off; set EXEMPLAR_PROFILE_EVERY or "
+        "EXEMPLAR_PROFILE_PATHS.", status=404, mimetype="text/plain")
+  sort = request.args.get("sort", "cumulative")
+  if sort not in pstats.Stats.sort_arg_dict_default:
+    return _text_error("sort must be one of {keys}.".format(
+        keys=", ".join(sorted(pstats.Stats.sort_arg_dict_default))), 400)
+  try:
+    lines = _int_arg("lines", 40)
+  except ValueError as e:
+    return _text_error(str(e), 400)
+  text = profiler.report(
+      route=request.args.get("route"), sort=sort, lines=lines)
   return Response(text, mimetype="text/plain")
 
 
+def _require_sampler():
+  _require_admin()
+  if sampler is None:
+    abort(_text_error(
+        "Stack sampling is off; set EXEMPLAR_STACK_SAMPLER.", 404))
+
+
+@app.route('/admin/sampler')
+def sampler_stacks():
+  # Collapsed stacks of the current or last run, for flamegraph.pl.
+  _require_sampler()
+  return Response(sampler.collapsed(), mimetype="text/plain")
+
+
+@app.route('/admin/sampler/start', methods=["POST"])
+def start_sampler():
+  # Optional query parameters: interval in seconds (default 0.005) and
+  # duration, after which sampling stops by itself (default 60).
+  _require_sampler()
+  started = sampler.start(
+      interval=max(0.001, request.args.get("interval", 0.005, type=float)),
+      max_duration=request.args.get("duration", 60, type=float))
+  return Response(
+      "Started.\n" if started else "Already running.\n", status=200 if
+      started else 409, mimetype="text/plain")
+
+
+@app.route('/admin/sampler/stop', methods=["POST"])
+def stop_sampler():
+  _require_sampler()
+  stopped = sampler.stop()
+  return Response(
+      "Stopped.\n" if stopped else "Not running.\n", status=200 if
+      stopped else 409, mimetype="text/plain")
+
+
+def _caches():
+  # The LRU caches worth watching, by name.
+  caches = {
+      "rendered_characters": rendered_characters,
+      "wrapped_items": chargen._wrapped_items,
+      "fragments": chargen._fragments}
+  catalog = chargen.current_catalog()
+  # Only caches already built; collecting must not build indexes.
+  for name in ("name_index", "search_index"):
+    index = catalog.__dict__.get(name)
+    if index is not None:
+      caches[name] = index.cache
+  return caches
+
+
+metrics.REGISTRY.collected(
+    "exemplar_cache_hits_total", "LRU cache hits.", ("cache",),
+    lambda: dict(((name,), c.hits) for name, c in _caches().items()),
+    "counter")
+metrics.REGISTRY.collected(
+    "exemplar_cache_misses_total", "LRU cache misses.", ("cache",),
+    lambda: dict(((name,), c.misses) for name, c in _caches().items()),
+    "counter")
+metrics.REGISTRY.collected(
+    "exemplar_cache_entries", "Entries held by each LRU cache.", ("cache",),
+    lambda: dict(((name,), len(c)) for name, c in _caches().items()))
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+  return Response(
+      metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.errorhandler(500)
 def server_error(e):
     # Log the error and stacktrace.
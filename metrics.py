@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import threading
+
+
+# --------------------------------------------------------------------------- #
+# Utilities.                                                                  #
+# --------------------------------------------------------------------------- #
+
+# Upper bounds, in seconds, of the default latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value):
+  if isinstance(value, str):
+    value = value.decode("utf-8", "replace")
+  return (unicode(value).replace("\\", "\\\\").replace("\n", "\\n")
+          .replace('"', '\\"'))
+
+
+def _format_labels(names, values, extra=()):
+  pairs = zip(names, values) + list(extra)
+  if not pairs:
+    return ""
+  return "{" + ",".join(
+      '{k}="{v}"'.format(k=k, v=_escape(v)) for k, v in pairs) + "}"
+
+
+def _format_value(value):
+  if value == float("inf"):
+    return "+Inf"
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# --------------------------------------------------------------------------- #
+# Main classes.                                                               #
+# --------------------------------------------------------------------------- #
+
+class _Sharded(object):
+  # Every thread records into its own dict of label values to data, so
+  # recording takes no lock; only a thread's first record takes one, to add
+  # its shard to the list that collection sums over. The shards of finished
+  # threads are folded into retired totals, so that totals never go
+  # backwards and a server starting a thread per request keeps only as many
+  # shards as it has live threads.
+
+  def __init__(self, name, documentation, labelnames=()):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+    self._local = threading.local()
+    self._shards = []
+    self._retired = {}
+    self._lock = threading.Lock()
+
+  def _shard(self):
+    shard = getattr(self._local, "shard", None)
+    if shard is None:
+      shard = self._local.shard = {}
+      with self._lock:
+        self._retire()
+        self._shards.append((threading.current_thread(), shard))
+    return shard
+
+  def _retire(self):
+    # Folds the shards of finished threads into _retired; needs _lock.
+    live = []
+    for thread, shard in self._shards:
+      if thread.is_alive():
+        live.append((thread, shard))
+      else:
+        for labels, value in shard.iteritems():
+          self._retired[labels] = self._fold(self._retired.get(labels), value)
+    self._shards = live
+
+  def _items(self):
+    # dict.items() copies under the GIL, so a shard's owner can keep
+    # recording while it is read.
+    with self._lock:
+      self._retire()
+      shards = [shard for _, shard in self._shards]
+      items = self._retired.items()
+    return items + [item for shard in shards for item in shard.items()]
+
+
+class Counter(_Sharded):
+  """A monotonically increasing count per combination of label values."""
+
+  TYPE = "counter"
+
+  def inc(self, labels=(), amount=1):
+    """Adds amount for the label values labels, a tuple in the order of
+    labelnames."""
+    shard = self._shard()
+    shard[labels] = shard.get(labels, 0) + amount
+
+  @staticmethod
+  def _fold(total, value):
+    return value if total is None else total + value
+
+  def values(self):
+    totals = {}
+    for labels, value in self._items():
+      totals[labels] = totals.get(labels, 0) + value
+    return totals
+
+  def samples(self):
+    for labels, value in sorted(self.values().items()):
+      yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Histogram(_Sharded):
+  """Counts observations into cumulative buckets, per label values."""
+
+  TYPE = "histogram"
+
+  def __init__(self, name, documentation, labelnames=(),
+               buckets=LATENCY_BUCKETS):
+    super(Histogram, self).__init__(name, documentation, labelnames)
+    self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+  def observe(self, value, labels=()):
+    shard = self._shard()
+    counts = shard.get(labels)
+    if counts is None:
+      # One count per bucket, then the sum of the observations.
+      counts = shard[labels] = [0] * len(self.buckets) + [0.0]
+    counts[bisect.bisect_left(self.buckets, value)] += 1
+    counts[-1] += value
+
+  @staticmethod
+  def _fold(total, counts):
+    # A new list, since collection may be reading the old one.
+    if total is None:
+      return list(counts)
+    return [a + b for a, b in zip(total, counts)]
+
+  def values(self):
+    totals = {}
+    for labels, counts in self._items():
+      counts = list(counts)
+      if labels in totals:
+        counts = [a + b for a, b in zip(totals[labels], counts)]
+      totals[labels] = counts
+    return totals
+
+  def samples(self):
+    for labels, counts in sorted(self.values().items()):
+      cumulative = 0
+      for bound, count in zip(self.buckets, counts):
+        cumulative += count
+        yield (self.name + "_bucket", _format_labels(
+            self.labelnames, labels, [("le", _format_value(bound))]),
+            cumulative)
+      label_text = _format_labels(self.labelnames, labels)
+      yield self.name + "_sum", label_text, counts[-1]
+      yield self.name + "_count", label_text, cumulative
+
+
+class _Gauge(object):
+  # Values read from elsewhere when collected, e.g. the counters LRUCache
+  # already keeps; fn returns {label values: value}.
+
+  def __init__(self, name, documentation, labelnames, fn, type_="gauge"):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+    self.fn = fn
+    self.TYPE = type_
+
+  def samples(self):
+    for labels, value in sorted(self.fn().items()):
+      yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Registry(object):
+  """A set of metrics rendered together in the Prometheus text format."""
+
+  def __init__(self):
+    self._metrics = []
+    self._lock = threading.Lock()
+
+  def register(self, metric):
+    with self._lock:
+      self._metrics.append(metric)
+    return metric
+
+  def counter(self, name, documentation, labelnames=()):
+    return self.register(Counter(name, documentation, labelnames))
+
+  def histogram(self, name, documentation, labelnames=(),
+                buckets=LATENCY_BUCKETS):
+    return self.register(Histogram(name, documentation, labelnames, buckets))
+
+  def collected(self, name, documentation, labelnames, fn, type_="gauge"):
+    """Registers a metric whose values fn returns at collection time."""
+    return self.register(_Gauge(name, documentation, labelnames, fn, type_))
+
+  def render(self):
+    with self._lock:
+      metrics = list(self._metrics)
+    lines = []
+    for metric in metrics:
+      lines.append("# HELP {name} {doc}".format(
+          name=metric.name, doc=metric.documentation))
+      lines.append("# TYPE {name} {type}".format(
+          name=metric.name, type=metric.TYPE))
+      for name, labels, value in metric.samples():
+        lines.append(u"{name}{labels} {value}".format(
+            name=name, labels=labels, value=_format_value(value)))
+    return u"\n".join(lines) + u"\n"
+
+
+REGISTRY = Registry()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+import metrics
+
+
+def _in_threads(n, fn):
+  # Runs fn in n short-lived threads, one after another.
+  for _ in xrange(n):
+    thread = threading.Thread(target=fn)
+    thread.start()
+    thread.join()
+
+
+class ShardTest(unittest.TestCase):
+
+  def setUp(self):
+    registry = metrics.Registry()
+    self.counter = registry.counter("c", "Counter.", ("route",))
+    self.histogram = registry.histogram("h", "Histogram.", ("route",))
+
+  def _record(self):
+    self.counter.inc(("/list",))
+    self.histogram.observe(0.003, ("/list",))
+
+  def test_finished_threads_do_not_pile_up(self):
+    _in_threads(500, self._record)
+    self.assertLessEqual(len(self.counter._shards), 1)
+    self.assertLessEqual(len(self.histogram._shards), 1)
+    self.counter.values()
+    self.assertEqual(self.counter._shards, [])
+
+  def test_totals_survive_finished_threads(self):
+    self._record()
+    _in_threads(50, self._record)
+    self.assertEqual(self.counter.values(), {("/list",): 51})
+    counts = self.histogram.values()[("/list",)]
+    self.assertEqual(counts[:-1], [0, 0, 51] + [0] * 10)
+    self.assertAlmostEqual(counts[-1], 51 * 0.003)
+    _in_threads(10, self._record)
+    self.assertEqual(self.counter.values(), {("/list",): 61})
+
+  def test_live_threads_keep_their_shards(self):
+    done = threading.Event()
+    recorded = []
+
+    def record_and_wait():
+      self._record()
+      recorded.append(True)
+      done.wait()
+
+    threads = [threading.Thread(target=record_and_wait) for _ in xrange(5)]
+    for thread in threads:
+      thread.start()
+    while len(recorded) < 5:
+      done.wait(0.001)
+    self.assertEqual(self.counter.values(), {("/list",): 5})
+    self.assertEqual(len(self.counter._shards), 5)
+    done.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(self.counter.values(), {("/list",): 5})
+    self.assertEqual(self.counter._shards, [])
+
+
+if __name__ == "__main__":
+  unittest.main()
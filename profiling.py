@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import cProfile
+import itertools
+import logging
+import os
+import pstats
+import re
+import StringIO
+import sys
+import threading
+import time
+
+from werkzeug.exceptions import HTTPException
+
+try:
+  # Threads that outlive a request on App Engine (manual scaling only).
+  from google.appengine.api.background_thread import BackgroundThread
+except ImportError:
+  BackgroundThread = threading.Thread
+
+
+# --------------------------------------------------------------------------- #
+# Main classes.                                                               #
+# --------------------------------------------------------------------------- #
+
+class SampledProfilerMiddleware(object):
+  """WSGI middleware that profiles a sample of requests into per-route
+  pstats aggregates.
+
+  A request is profiled if it is the every-th one or its path matches
+  paths, a regular expression. The profiler runs while the app is called
+  and while each chunk of the response is produced, so streamed bodies are
+  neither buffered nor left out. Samples are merged per URL rule; every
+  dump_interval seconds the aggregates are dumped, to one file per route
+  under dump_dir or else to the log, and a new window is started.
+  """
+
+  def __init__(self, app, url_map, every=100, paths=None, dump_dir=None,
+               dump_interval=600, dump_lines=25):
+    self.app = app
+    self.url_map = url_map
+    self.every = every
+    self.paths = re.compile(paths) if paths else None
+    self.dump_dir = dump_dir
+    self.dump_interval = dump_interval
+    self.dump_lines = dump_lines
+    self._counter = itertools.count(1)
+    self._lock = threading.Lock()
+    self._stats = {}
+    self._samples = {}
+    self._window_start = time.time()
+
+  def __call__(self, environ, start_response):
+    path = environ.get("PATH_INFO", "")
+    sampled = (
+        (self.every and next(self._counter) % self.every == 0) or
+        (self.paths is not None and self.paths.search(path)))
+    if not sampled:
+      return self.app(environ, start_response)
+    profile = cProfile.Profile()
+    body = profile.runcall(self.app, environ, start_response)
+    return _ProfiledBody(body, profile, lambda: self._add(environ, profile))
+
+  def _route(self, environ):
+    try:
+      rule, _ = self.url_map.bind_to_environ(environ).match(return_rule=True)
+      return rule.rule
+    except HTTPException:
+      return "(unmatched)"
+
+  def _add(self, environ, profile):
+    route = self._route(environ)
+    stats = pstats.Stats(profile)
+    with self._lock:
+      if route in self._stats:
+        self._stats[route].add(stats)
+      else:
+        self._stats[route] = stats
+      self._samples[route] = self._samples.get(route, 0) + 1
+      due = time.time() - self._window_start >= self.dump_interval
+    if due:
+      self.dump()
+
+  def routes(self):
+    """Returns {route: number of profiled requests} for this window."""
+    with self._lock:
+      return dict(self._samples)
+
+  def report(self, route=None, sort="cumulative", lines=40):
+    """Text report of the aggregate for route, or for every route."""
+    with self._lock:
+      routes = [route] if route else sorted(self._stats)
+      out = StringIO.StringIO()
+      out.write("Window of {s:.0f} s.\n".format(
+          s=time.time() - self._window_start))
+      for r in routes:
+        if r not in self._stats:
+          continue
+        out.write("\n=== {route} ({n} requests)\n".format(
+            route=r, n=self._samples[r]))
+        stats = self._stats[r]
+        stats.stream = out
+        stats.sort_stats(sort).print_stats(lines)
+      return out.getvalue()
+
+  def dump(self):
+    """Writes out the current aggregates and starts a new window."""
+    with self._lock:
+      stats, samples = self._stats, self._samples
+      self._stats, self._samples = {}, {}
+      self._window_start = time.time()
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    for route, s in sorted(stats.items()):
+      if self.dump_dir:
+        name = re.sub(r"[^\w.-]+", "_", route).strip("_") or "root"
+        s.dump_stats(os.path.join(
+            self.dump_dir, "{name}.{stamp}.pstats".format(
+                name=name, stamp=stamp)))
+      else:
+        out = StringIO.StringIO()
+        s.stream = out
+        s.sort_stats("cumulative").print_stats(self.dump_lines)
+        logging.info("Profile of %s over %d requests:\n%s",
+                     route, samples[route], out.getvalue())
+
+
+class SamplingProfilerMiddleware(object):
+  """WSGI middleware that samples the stacks of threads serving requests.
+
+  While running, a background thread wakes every interval seconds, reads
+  every thread's current frame with sys._current_frames() and counts the
+  stacks of those in the middle of a request, from the app call until the
+  server closes the response. Unlike cProfile nothing is added to each
+  function call, so short functions are not distorted. collapsed() gives the
+  counts in the collapsed-stack format of flamegraph.pl. Sampling stops by
+  itself after max_duration seconds. When not running, requests pass through
+  untouched.
+
+  On App Engine the sampling thread is a BackgroundThread, which only
+  manually scaled instances may start; elsewhere it is a daemon thread.
+  """
+
+  def __init__(self, app):
+    self.app = app
+    self.interval = None
+    self._active = {}
+    self._counts = collections.Counter()
+    self._lock = threading.Lock()
+    self._stop = None
+    self._thread = None
+
+  @property
+  def running(self):
+    return self._thread is not None and self._thread.is_alive()
+
+  def __call__(self, environ, start_response):
+    if not self.running:
+      return self.app(environ, start_response)
+    ident = threading.current_thread().ident
+    self._active[ident] = True
+    try:
+      body = self.app(environ, start_response)
+    except Exception:
+      self._active.pop(ident, None)
+      raise
+    return _ProfiledBody(body, None, lambda: self._active.pop(ident, None))
+
+  def start(self, interval=0.005, max_duration=60):
+    """Starts sampling, discarding the stacks of any earlier run."""
+    with self._lock:
+      if self.running:
+        return False
+      self.interval = interval
+      self._counts = collections.Counter()
+      self._stop = threading.Event()
+      self._thread = BackgroundThread(
+          target=self._sample, args=(self._stop, interval, max_duration),
+          name="stack-sampler")
+      self._thread.daemon = True
+      self._thread.start()
+      return True
+
+  def stop(self):
+    with self._lock:
+      if not self.running:
+        return False
+      self._stop.set()
+      self._thread.join()
+      return True
+
+  def _sample(self, stop, interval, max_duration):
+    deadline = time.time() + max_duration
+    counts = self._counts
+    while not stop.is_set() and time.time() < deadline:
+      time.sleep(interval)
+      frames = sys._current_frames()
+      for ident in self._active.keys():
+        frame = frames.get(ident)
+        if frame is not None:
+          counts[_collapse(frame)] += 1
+    self._active.clear()
+
+  def collapsed(self):
+    """Returns "frame;frame;... count" lines, outermost frame first."""
+    counts = self._counts
+    return "".join(
+        "{stack} {n}\n".format(stack=stack, n=n)
+        for stack, n in sorted(counts.items()))
+
+
+def _collapse(frame):
+  names = []
+  while frame is not None:
+    code = frame.f_code
+    names.append("{file}:{name}".format(
+        file=os.path.basename(code.co_filename), name=code.co_name))
+    frame = frame.f_back
+  return ";".join(reversed(names))
+
+
+class _ProfiledBody(object):
+  # Wraps a WSGI response iterable, profiling the production of each chunk
+  # (unless profile is None) and calling done once the server closes it.
+
+  def __init__(self, body, profile, done):
+    self._body = body
+    self._chunks = iter(body)
+    self._profile = profile
+    self._done = done
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    if self._profile is None:
+      return next(self._chunks)
+    return self._profile.runcall(next, self._chunks)
+
+  def close(self):
+    try:
+      if hasattr(self._body, "close"):
+        self._body.close()
+    finally:
+      self._done()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import httplib
+import json
+import Queue
+import threading
+import timeit
+
+import vendored  # Puts lib/ on sys.path; keep it above click.
+
+import click
+from werkzeug import serving
+from werkzeug.exceptions import HTTPException
+
+import bench
+import main
+
+
+# --------------------------------------------------------------------------- #
+# Utilities.                                                                  #
+# --------------------------------------------------------------------------- #
+
+# One request per line: {"path": "/list?width=60", "method": "GET",
+# "timestamp": 1484936886.25}, with timestamps in seconds. method defaults
+# to GET.
+TRAFFIC_PATH = "traffic.jsonl"
+
+
+def read_traffic(f):
+  entries = []
+  for line in f:
+    line = line.strip()
+    if line:
+      entry = json.loads(line)
+      entries.append((
+          float(entry.get("timestamp", 0)),
+          entry.get("method", "GET").upper(),
+          entry["path"].encode("utf-8")))
+  entries.sort()
+  return entries
+
+
+def route_of(adapter, method, path):
+  # The URL rule a path is served by, so /Armored,Medic and /Medic,Spy are
+  # reported together.
+  try:
+    rule, _ = adapter.match(path.partition("?")[0], method, return_rule=True)
+    return rule.rule
+  except HTTPException:
+    return "(unmatched)"
+
+
+class _InProcessClient(object):
+
+  def __init__(self):
+    self.client = main.app.test_client()
+
+  def __call__(self, method, path):
+    response = self.client.open(path, method=method)
+    response.get_data()
+    return response.status_code
+
+
+class _HTTPClient(object):
+
+  def __init__(self, host, port):
+    self.host, self.port = host, port
+
+  def __call__(self, method, path):
+    conn = httplib.HTTPConnection(self.host, self.port)
+    try:
+      conn.request(method, path)
+      response = conn.getresponse()
+      response.read()
+      return response.status
+    finally:
+      conn.close()
+
+
+def replay(entries, make_client, concurrency=8, speed=1.0):
+  """Sends entries from concurrency threads, each at its timestamp relative
+  to the first divided by speed (0 sends them back to back).
+
+  Returns ([(route, status, latency ms)], elapsed seconds), with status 0
+  for requests the client failed to complete.
+  """
+  adapter = main.app.url_map.bind("localhost")
+  timer = timeit.default_timer
+  queue = Queue.Queue(maxsize=4 * concurrency)
+  results = []
+
+  def work():
+    send = make_client()
+    while True:
+      entry = queue.get()
+      if entry is None:
+        return
+      method, path = entry
+      start = timer()
+      try:
+        status = send(method, path)
+      except Exception:
+        status = 0
+      results.append((
+          route_of(adapter, method, path), status, (timer() - start) * 1000))
+
+  threads = [threading.Thread(target=work) for _ in xrange(concurrency)]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  start = timer()
+  first = entries[0][0] if entries else 0
+  for timestamp, method, path in entries:
+    if speed:
+      delay = start + (timestamp - first) / speed - timer()
+      if delay > 0:
+        threading.Event().wait(delay)
+    queue.put((method, path))
+  for _ in threads:
+    queue.put(None)
+  for thread in threads:
+    thread.join()
+  return results, timer() - start
+
+
+def summarize(results, elapsed):
+  """Per-route request counts, errors (5xx responses and failed requests),
+  throughput and latency percentiles."""
+  by_route = collections.defaultdict(list)
+  for route, status, latency in results:
+    by_route[route].append((latency, status))
+  summary = {}
+  for route, samples in by_route.iteritems():
+    latencies = sorted(latency for latency, _ in samples)
+    row = dict(
+        ("p{}".format(p), bench.percentile(latencies, p))
+        for p in bench.PERCENTILES)
+    row.update(
+        n=len(samples), max=latencies[-1],
+        errors=sum(1 for _, status in samples if status == 0 or status >= 500),
+        rps=len(samples) / elapsed if elapsed else 0.0)
+    summary[route] = row
+  return summary
+
+
+# --------------------------------------------------------------------------- #
+# Driver.                                                                     #
+# --------------------------------------------------------------------------- #
+
+@click.command()
+@click.argument("traffic", type=click.File("rb"), default=TRAFFIC_PATH)
+@click.option("--http", is_flag=True,
+              help="Serve the app with werkzeug.serving on localhost and "
+                   "replay over HTTP instead of through the test client.")
+@click.option("--port", default=0, type=int,
+              help="Port for --http (default: any free port).")
+@click.option("--concurrency", "-c", default=8, type=click.IntRange(min=1))
+@click.option("--speed", "-s", default=1.0, type=float,
+              help="Time compression; 10 replays ten times faster than "
+                   "recorded, 0 as fast as possible.")
+@click.option("--json", "as_json", is_flag=True,
+              help="Print the report as JSON.")
+def cli(traffic, http, port, concurrency, speed, as_json):
+  """Replays a TRAFFIC file (default traffic.jsonl) against main.app."""
+  if speed < 0:
+    raise click.BadParameter("must not be negative", param_hint="--speed")
+  entries = read_traffic(traffic)
+  if http:
+    server = serving.make_server("127.0.0.1", port, main.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    host, port = server.server_address
+    make_client = lambda: _HTTPClient(host, port)
+  else:
+    make_client = _InProcessClient
+  results, elapsed = replay(entries, make_client, concurrency, speed)
+  if http:
+    server.shutdown()
+  summary = summarize(results, elapsed)
+  if as_json:
+    click.echo(json.dumps(
+        {"elapsed": elapsed, "routes": summary}, indent=2, sort_keys=True))
+    return
+  click.echo("{n} requests in {s:.2f} s ({rps:.1f}/s)".format(
+      n=len(results), s=elapsed, rps=len(results) / elapsed if elapsed else 0))
+  click.echo("{route:<30} {n:>6} {err:>4} {rps:>8} {p50:>9} {p90:>9} "
+             "{p99:>9}".format(
+                 route="route", n="n", err="err", rps="req/s",
+                 p50="p50 ms", p90="p90 ms", p99="p99 ms"))
+  for route, row in sorted(summary.items()):
+    click.echo("{route:<30} {n:>6} {errors:>4} {rps:>8.1f} {p50:>9.3f} "
+               "{p90:>9.3f} {p99:>9.3f}".format(route=route, **row))
+
+
+if __name__ == "__main__":
+  cli()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import re
+
+import lru
+
+
+_WORD_RE = re.compile(r"\w+")
+
+
+class AhoCorasick(object):
+  """Finds which of a fixed set of patterns occur in a text, in one pass.
+
+  A trie of the patterns with failure links (the Aho-Corasick automaton);
+  search() costs time linear in the text plus the number of matches,
+  however many patterns there are.
+  """
+
+  def __init__(self, patterns):
+    self.patterns = list(patterns)
+    self._goto = [{}]
+    self._fail = [0]
+    self._out = [[]]
+    for i, pattern in enumerate(self.patterns):
+      state = 0
+      for ch in pattern:
+        nxt = self._goto[state].get(ch)
+        if nxt is None:
+          nxt = len(self._goto)
+          self._goto[state][ch] = nxt
+          self._goto.append({})
+          self._fail.append(0)
+          self._out.append([])
+        state = nxt
+      self._out[state].append(i)
+    # Breadth first from the root's children, whose failure links stay 0.
+    queue = collections.deque(self._goto[0].values())
+    while queue:
+      state = queue.popleft()
+      for ch, nxt in self._goto[state].iteritems():
+        queue.append(nxt)
+        fail = self._fail[state]
+        while fail and ch not in self._goto[fail]:
+          fail = self._fail[fail]
+        self._fail[nxt] = self._goto[fail].get(ch, 0)
+        self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+  def search(self, text):
+    """Returns the set of indices of the patterns that occur in text."""
+    goto, fail, out = self._goto, self._fail, self._out
+    found = set(out[0])
+    state = 0
+    for ch in text:
+      while state and ch not in goto[state]:
+        state = fail[state]
+      state = goto[state].get(ch, 0)
+      if out[state]:
+        found.update(out[state])
+    return found
+
+
+def iter_bits(mask):
+  """Yields the indices of the set bits of mask, lowest first."""
+  while mask:
+    low = mask & -mask
+    yield low.bit_length() - 1
+    mask ^= low
+
+
+class SearchIndex(object):
+  """Substring and whole-word search over a fixed list of documents.
+
+  Postings are bitmasks over document positions. Every substring of up to
+  GRAM characters has one, so short terms are answered from postings alone
+  and longer ones are narrowed to documents holding all of their GRAM-grams
+  before the substring is confirmed. Whole words have postings of their own.
+  Results come back in document order and recent queries are cached.
+  """
+
+  GRAM = 3
+
+  def __init__(self, docs, cache_size=512):
+    self.docs = list(docs)
+    self.everything = (1 << len(self.docs)) - 1
+    self.grams = {}
+    self.words = {}
+    for i, doc in enumerate(self.docs):
+      bit = 1 << i
+      for n in xrange(1, self.GRAM + 1):
+        for gram in set(doc[j:j + n] for j in xrange(len(doc) - n + 1)):
+          self.grams[gram] = self.grams.get(gram, 0) | bit
+      for word in set(_WORD_RE.findall(doc)):
+        self.words[word] = self.words.get(word, 0) | bit
+    self.cache = lru.LRUCache(cache_size)
+
+  def substring(self, term, within=None):
+    """Bitmask of the documents containing term."""
+    mask = self.everything if within is None else within
+    if len(term) <= self.GRAM:
+      return mask & self.grams.get(term, 0) if term else mask
+    for j in xrange(len(term) - self.GRAM + 1):
+      mask &= self.grams.get(term[j:j + self.GRAM], 0)
+      if not mask:
+        return 0
+    for i in iter_bits(mask):
+      if term not in self.docs[i]:
+        mask &= ~(1 << i)
+    return mask
+
+  def phrase(self, term, within=None):
+    """Bitmask of the documents containing term as whole words."""
+    mask = self.everything if within is None else within
+    words = _WORD_RE.findall(term)
+    if not words:
+      return 0
+    for word in words:
+      mask &= self.words.get(word, 0)
+    if len(words) > 1 or words[0] != term:
+      pattern = re.compile(r"\b" + re.escape(term) + r"\b")
+      for i in iter_bits(mask):
+        if not pattern.search(self.docs[i]):
+          mask &= ~(1 << i)
+    return mask
+
+  def search(self, terms):
+    """Returns the positions of the documents matching every term, in order.
+
+    A term wrapped in double quotes matches whole words; any other term
+    matches as a substring.
+    """
+    key = tuple(terms)
+    found = self.cache.get(key)
+    if found is None:
+      mask = self.everything
+      for term in terms:
+        if len(term) >= 2 and term[0] == term[-1] == '"':
+          mask = self.phrase(term[1:-1], mask)
+        else:
+          mask = self.substring(term, mask)
+        if not mask:
+          break
+      found = tuple(iter_bits(mask))
+      self.cache.put(key, found)
+    return found
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import random
+import re
+import unittest
+
+import chargen
+import textindex
+
+
+def _scan(docs, terms):
+  # The positions of the documents matching every term, the slow way.
+  def matches(doc, term):
+    if len(term) >= 2 and term[0] == term[-1] == '"':
+      return re.search(r"\b" + re.escape(term[1:-1]) + r"\b", doc)
+    return term in doc
+  return tuple(
+      i for i, doc in enumerate(docs)
+      if all(matches(doc, term) for term in terms))
+
+
+class SearchIndexTest(unittest.TestCase):
+  # SearchIndex must find exactly what scanning every document finds.
+
+  @classmethod
+  def setUpClass(cls):
+    cls.docs = [a.raw_text for a in chargen.load_catalog().listing]
+    cls.index = textindex.SearchIndex(cls.docs)
+    cls.rng = random.Random(0)
+
+  def _check(self, queries):
+    for terms in queries:
+      self.assertEqual(
+          self.index.search(terms), _scan(self.docs, terms), terms)
+
+  def _substring(self):
+    doc = self.rng.choice(self.docs)
+    i = self.rng.randrange(len(doc))
+    return doc[i:i + self.rng.randint(1, 12)]
+
+  def test_substrings(self):
+    letters = sorted(set("".join(self.docs)))
+    terms = [self._substring() for _ in xrange(2000)]
+    terms += [
+        "".join(self.rng.choice(letters) for _ in xrange(4))
+        for _ in xrange(500)]
+    self._check([term] for term in terms)
+
+  def test_whole_words(self):
+    words = sorted(set(
+        word for doc in self.docs for word in re.findall(r"\w+", doc)))
+    self._check(['"{}"'.format(word)] for word in words)
+    phrases = []
+    for _ in xrange(500):
+      doc = self.rng.choice(self.docs).split()
+      i = self.rng.randrange(len(doc))
+      phrases.append(" ".join(doc[i:i + 2]).strip(".,;:()"))
+    self._check(['"{}"'.format(p)] for p in phrases if p)
+
+  def test_every_term_must_match(self):
+    self._check(
+        [self._substring() for _ in xrange(self.rng.randint(2, 3))]
+        for _ in xrange(1000))
+    self._check([["armor", '"steel"'], ["3d, vehicles", "prowess"]])
+
+
+if __name__ == "__main__":
+  unittest.main()
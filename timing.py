@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import timeit
+
+
+# Set EXEMPLAR_TIMING to record how long each phase of a request takes.
+# When unset, phase() hands back one shared do-nothing context manager.
+ENABLED = bool(os.environ.get("EXEMPLAR_TIMING"))
+
+_timer = timeit.default_timer
+_local = threading.local()
+
+
+class _Phase(object):
+  __slots__ = ("phases", "name", "start")
+
+  def __init__(self, phases, name):
+    self.phases = phases
+    self.name = name
+
+  def __enter__(self):
+    self.start = _timer()
+
+  def __exit__(self, *exc_info):
+    self.phases[self.name] = (
+        self.phases.get(self.name, 0.0) + _timer() - self.start)
+
+
+class _NoPhase(object):
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exc_info):
+    pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+def phase(name):
+  """Context manager adding the time spent inside it to phase name of the
+  current request. Repeated phases add up; nested ones overlap."""
+  phases = getattr(_local, "phases", None) if ENABLED else None
+  if phases is None:
+    return _NO_PHASE
+  return _Phase(phases, name)
+
+
+def timed(name, iterable):
+  """Yields from iterable, counting the time taken to produce each item
+  towards phase name."""
+  phases = getattr(_local, "phases", None) if ENABLED else None
+  if phases is None:
+    return iterable
+  return _timed(_Phase(phases, name), iter(iterable))
+
+
+def _timed(p, it):
+  while True:
+    with p:
+      item = next(it, p)
+    if item is p:
+      return
+    yield item
+
+
+def begin():
+  """Starts recording phases for the request on this thread."""
+  _local.phases = {}
+  _local.start = _timer()
+
+
+def end():
+  """Stops recording and returns ({phase: seconds}, seconds since begin)."""
+  phases = getattr(_local, "phases", None) or {}
+  elapsed = _timer() - getattr(_local, "start", _timer())
+  _local.phases = None
+  return phases, elapsed
+
+
+def server_timing(phases, total=None):
+  """Formats phases as a Server-Timing header value, in milliseconds."""
+  metrics = [
+      "{name};dur={ms:.2f}".format(name=name, ms=seconds * 1000)
+      for name, seconds in sorted(phases.items())]
+  if total is not None:
+    metrics.append("total;dur={ms:.2f}".format(ms=total * 1000))
+  return ", ".join(metrics)
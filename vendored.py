@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+
+# Flask, Werkzeug and click are vendored under lib/ for App Engine, where
+# appengine_config.py puts it on the path. The command-line tools import
+# this module, before any of those, to do the same.
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lib")
+
+if LIB_DIR not in sys.path:
+  sys.path.insert(0, LIB_DIR)